@@ -0,0 +1,163 @@
+#!/usr/local/autopkg/python
+# Copyright (C) 2014 Shea G Craig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""fake_jss_benchmark.py
+
+Time jss_recipe_creator.py against fake_jss_server.py.
+
+Starts a fake JSS for each inventory size given, drives the creator
+against it in --auto mode, and prints how long each recipe took through
+the menus and through the direct answer resolver. Each side has its
+own request scheduler, so neither gets the other's cached results, and
+both look up the same group afterwards, as the scope menu does. It
+stops with an error if the two ever disagree. The answers themselves are tested more
+thoroughly by test_jss_recipe_creator.py.
+
+usage: fake_jss_benchmark.py [options]
+
+options:
+  --sizes N,N,...       Group counts to test. Default 10,100,1000,10000,50000.
+  --recipes N           Recipes to generate per size. Default 20.
+  --no_cache            Disable the request scheduler's result cache.
+  --requests_per_second N
+                        The request schedulers' rate limit. Default 0 (no
+                        limit), so that the times measure the creator
+                        rather than the throttle.
+  -r RECIPE_TEMPLATE    Recipe template to generate recipes from. Defaults
+                        to Templates/RecipeTemplate.plist.
+
+  Any fake_jss_server.py inventory and misbehavior options (--groups
+  aside) are accepted too.
+"""
+
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import random
+import sys
+import tempfile
+import time
+
+# pylint: disable=import-error
+import jss
+# pylint: enable=import-error
+
+import jss_recipe_creator as creator
+from fake_jss_server import FakeJSS, FakeJSSServer, add_fake_jss_arguments
+
+
+def run_load(args):
+    """Time the creator against a fake JSS for each inventory size.
+
+    Each synthetic parent is run through both the --auto menu and the
+    direct answer resolver, and the run stops if their answers differ.
+    """
+    template = creator.JSSRecipe(args.recipe_template)
+    template["Input"]["CATEGORY"] = "Category 1"
+    template["Input"]["SELF_SERVICE_DESCRIPTION"] = "Load test."
+    template_data = template.serialize()
+
+    def new_recipe():
+        """Return a fresh copy of the template."""
+        with tempfile.NamedTemporaryFile(suffix=".recipe") as handle:
+            handle.write(template_data)
+            handle.flush()
+            return creator.JSSRecipe(handle.name)
+
+    # The settings which the times depend on most.
+    print("Rate limit: %s; cache: %s; latency: %gs; error rate: %g; "
+          "429 rate: %g" % (
+              "%g requests/s" % args.requests_per_second if
+              args.requests_per_second else "off",
+              "off" if args.no_cache else "%ds" % creator.JSS_CACHE_TTL,
+              args.latency, args.error_rate, args.throttle_rate))
+    print("%8s %8s %14s %14s %10s" % ("groups", "recipes", "menu s/recipe",
+                                       "auto s/recipe", "requests"))
+    for size in args.sizes:
+        fake = FakeJSS(categories=args.categories, groups=size,
+                       smart_ratio=args.smart_ratio, latency=args.latency,
+                       error_rate=args.error_rate,
+                       throttle_rate=args.throttle_rate,
+                       max_rps=args.max_rps)
+        server = FakeJSSServer(fake)
+        server.start()
+        menu_j, auto_j = [
+            creator.JSSRequestScheduler(
+                jss.JSS(url=server.url, user="user", password="password",
+                        ssl_verify=False, suppress_warnings=True),
+                requests_per_second=args.requests_per_second,
+                cache_ttl=0 if args.no_cache else creator.JSS_CACHE_TTL)
+            for _ in range(2)]
+
+        menu_time = auto_time = 0.0
+        for index in range(args.recipes):
+            parent = {"Identifier": "com.example.pkg.Product%d" % index,
+                      "Input": {"NAME": "Product%d" % index},
+                      "Process": []}
+            filename = "Product%d.pkg.recipe" % index
+            group = "Group %d" % random.randint(1, size * 2)
+
+            recipe = new_recipe()
+            start = time.time()
+            menu = creator.build_menu(menu_j, parent, recipe, filename, {},
+                                      False)
+            menu.run(auto=True, package_only=False)
+            creator.check_group(menu_j, group)
+            menu_time += time.time() - start
+
+            recipe = new_recipe()
+            start = time.time()
+            results = creator.resolve_answers(auto_j, parent, recipe,
+                                              filename, {}, False)
+            creator.check_group(auto_j, group)
+            auto_time += time.time() - start
+
+            if results != menu.results:
+                server.shutdown()
+                sys.exit("Resolver and menu answers differ for %s:\n%s\n%s" %
+                         (filename, results, menu.results))
+        server.shutdown()
+        server.server_close()
+
+        print("%8d %8d %14.5f %14.5f %10d" % (
+            size, args.recipes, menu_time / max(1, args.recipes),
+            auto_time / max(1, args.recipes), sum(fake.requests.values())))
+
+
+def build_argparser():
+    """Create the benchmark argument parser."""
+    parser = argparse.ArgumentParser(
+        description="Time jss_recipe_creator.py against a fake JSS.")
+    add_fake_jss_arguments(parser)
+    parser.add_argument(
+        "--sizes", default=[10, 100, 1000, 10000, 50000],
+        type=lambda val: [int(size) for size in val.split(",")])
+    parser.add_argument("--recipes", type=int, default=20)
+    parser.add_argument("--no_cache", action="store_true")
+    parser.add_argument("--requests_per_second", type=float, default=0)
+    parser.add_argument("-r", "--recipe_template",
+                        default="Templates/RecipeTemplate.plist")
+    return parser
+
+
+def main():
+    """Commandline processing of the benchmark."""
+    run_load(build_argparser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
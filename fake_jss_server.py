@@ -0,0 +1,312 @@
+#!/usr/local/autopkg/python
+# Copyright (C) 2014 Shea G Craig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""fake_jss_server.py
+
+A local stand-in for the Jamf Pro classic API, for load and latency
+testing of jss_recipe_creator.py without touching a production server.
+
+Only the parts of the API that JSSRecipeCreator uses are implemented:
+listing, reading and creating categories and computer groups.
+
+The server is used by test_jss_recipe_creator.py and
+fake_jss_benchmark.py. Run on its own, it serves in the foreground;
+point python-jss at it with JSS_URL http://localhost:PORT. Any
+credentials are accepted.
+
+usage: fake_jss_server.py [options]
+
+options:
+  --categories N        Number of categories to serve. Default 50.
+  --groups N            Number of computer groups to serve. Default 1000.
+  --smart_ratio RATIO   Fraction of the groups which are smart. Default 0.5.
+  --latency SECONDS     Delay added to every request. Default 0.
+  --error_rate RATE     Fraction of requests answered with a 500.
+  --throttle_rate RATE  Fraction of requests answered with a 429.
+  --max_rps N           Answer with a 429 beyond N requests per second.
+  --port PORT           Port to listen on. Default 8444.
+"""
+
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import random
+import sys
+import threading
+import time
+from xml.etree import ElementTree
+
+# pylint: disable=import-error
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote
+# pylint: enable=import-error
+
+
+# Endpoint path: (list tag, object tag).
+ENDPOINTS = {"categories": ("categories", "category"),
+             "computergroups": ("computer_groups", "computer_group")}
+
+
+class FakeJSS(object):
+    """Inventory and misbehavior settings for a fake JSS.
+
+    Attributes:
+        objects: Dict of endpoint path to a list of object dicts, each
+            with "id", "name" and, for groups, "is_smart".
+        latency: Float seconds to sleep before answering.
+        error_rate: Float fraction of requests to fail with a 500.
+        throttle_rate: Float fraction of requests to fail with a 429.
+        max_rps: Int requests per second beyond which requests fail
+            with a 429. 0 for no limit.
+        requests: Dict counting requests by (method, endpoint).
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, categories=50, groups=1000, smart_ratio=0.5,
+                 latency=0.0, error_rate=0.0, throttle_rate=0.0, max_rps=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self.objects = {
+            "categories": [{"id": index, "name": "Category %d" % index}
+                           for index in range(1, categories + 1)],
+            "computergroups": [
+                {"id": index, "name": "Group %d" % index,
+                 "is_smart": index <= int(groups * smart_ratio)}
+                for index in range(1, groups + 1)]}
+        self._index = {}
+        for endpoint in self.objects:
+            self._reindex(endpoint)
+    # pylint: enable=too-many-arguments
+
+    def _reindex(self, endpoint):
+        """Rebuild the id and name lookups for an endpoint."""
+        lookup = {}
+        for obj in self.objects[endpoint]:
+            lookup[("id", str(obj["id"]))] = obj
+            lookup[("name", obj["name"])] = obj
+        self._index[endpoint] = lookup
+
+    def count(self, method, endpoint):
+        """Record a request."""
+        with self._lock:
+            key = (method, endpoint)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def misbehave(self):
+        """Return an HTTP error status to fail a request with, or None."""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.max_rps:
+            with self._lock:
+                second, seen = self._window
+                now = int(time.time())
+                seen = seen + 1 if now == second else 1
+                self._window = (now, seen)
+            if seen > self.max_rps:
+                return 429
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def find(self, endpoint, key, value):
+        """Return the object dict matching key ("id" or "name")."""
+        with self._lock:
+            return self._index[endpoint].get((key, value))
+
+    def create(self, endpoint, element):
+        """Add an object from POSTed XML and return it."""
+        with self._lock:
+            objects = self.objects[endpoint]
+            obj = {"id": (objects[-1]["id"] if objects else 0) + 1,
+                   "name": element.findtext("name", "")}
+            if endpoint == "computergroups":
+                obj["is_smart"] = element.findtext("is_smart") == "true"
+            objects.append(obj)
+            self._index[endpoint][("id", str(obj["id"]))] = obj
+            self._index[endpoint][("name", obj["name"])] = obj
+        return obj
+
+    @staticmethod
+    def to_xml(endpoint, obj, listing=False):
+        """Return an ElementTree.Element for an object dict."""
+        element = ElementTree.Element(ENDPOINTS[endpoint][1])
+        ElementTree.SubElement(element, "id").text = str(obj["id"])
+        ElementTree.SubElement(element, "name").text = obj["name"]
+        if "is_smart" in obj:
+            ElementTree.SubElement(element, "is_smart").text = (
+                "true" if obj["is_smart"] else "false")
+        if endpoint == "categories" and not listing:
+            ElementTree.SubElement(element, "priority").text = "9"
+        return element
+
+    def list_xml(self, endpoint):
+        """Return an ElementTree.Element listing every object."""
+        list_tag = ENDPOINTS[endpoint][0]
+        element = ElementTree.Element(list_tag)
+        with self._lock:
+            objects = list(self.objects[endpoint])
+        ElementTree.SubElement(element, "size").text = str(len(objects))
+        for obj in objects:
+            element.append(self.to_xml(endpoint, obj, listing=True))
+        return element
+
+
+class FakeJSSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer classic API requests from the server's FakeJSS."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle listing and lookup by id or name."""
+        endpoint, key, value = self._parse_path()
+        fake = self.server.fake_jss
+        fake.count("GET", endpoint)
+        status = fake.misbehave()
+        if status:
+            return self._send(status)
+        if endpoint not in ENDPOINTS:
+            return self._send(404)
+        if key is None:
+            return self._send(200, fake.list_xml(endpoint))
+        obj = fake.find(endpoint, key, value)
+        if obj is None:
+            return self._send(404)
+        return self._send(200, fake.to_xml(endpoint, obj))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handle object creation (POST to id/0)."""
+        endpoint, key, value = self._parse_path()
+        fake = self.server.fake_jss
+        fake.count("POST", endpoint)
+        status = fake.misbehave()
+        if status:
+            return self._send(status)
+        if endpoint not in ENDPOINTS or (key, value) != ("id", "0"):
+            return self._send(404)
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            element = ElementTree.fromstring(self.rfile.read(length))
+        except ElementTree.ParseError:
+            return self._send(400)
+        if fake.find(endpoint, "name", element.findtext("name", "")):
+            return self._send(409)
+        obj = fake.create(endpoint, element)
+        response = ElementTree.Element(ENDPOINTS[endpoint][1])
+        ElementTree.SubElement(response, "id").text = str(obj["id"])
+        return self._send(201, response)
+
+    def _parse_path(self):
+        """Split the request path into (endpoint, key, value)."""
+        parts = [unquote(part) for part in
+                 self.path.split("?")[0].strip("/").split("/")]
+        if parts and parts[0] == "JSSResource":
+            parts = parts[1:]
+        endpoint = parts[0] if parts else ""
+        if len(parts) >= 3:
+            return endpoint, parts[1], parts[2]
+        return endpoint, None, None
+
+    def _send(self, status, element=None):
+        """Send a response, with an XML body if one is given."""
+        if element is None:
+            body = ("<html><body><p>Error %d</p></body></html>" %
+                    status).encode("utf-8")
+            content_type = "text/html;charset=UTF-8"
+        else:
+            body = ElementTree.tostring(element, encoding="UTF-8")
+            content_type = "text/xml;charset=UTF-8"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep quiet; load runs make a lot of requests."""
+        pass
+
+
+class FakeJSSServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server for a FakeJSS."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fake_jss, port=0):
+        """Bind to localhost:port (0 picks a free port)."""
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                           FakeJSSHandler)
+        self.fake_jss = fake_jss
+
+    @property
+    def url(self):
+        """The URL to give python-jss."""
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        """Serve from a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def build_argparser():
+    """Create the fake server argument parser."""
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the Jamf Pro classic API.")
+    add_fake_jss_arguments(parser)
+    parser.add_argument("--port", type=int, default=8444)
+    return parser
+
+
+def add_fake_jss_arguments(parser):
+    """Add the FakeJSS inventory and misbehavior options to a parser."""
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--smart_ratio", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--throttle_rate", type=float, default=0.0)
+    parser.add_argument("--max_rps", type=int, default=0)
+
+
+def main():
+    """Commandline processing of the fake JSS server."""
+    args = build_argparser().parse_args()
+    server = FakeJSSServer(
+        FakeJSS(categories=args.categories, groups=args.groups,
+                smart_ratio=args.smart_ratio, latency=args.latency,
+                error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                max_rps=args.max_rps),
+        port=args.port)
+    print("Serving a fake JSS at %s (Ctrl-C to stop)" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    sys.exit()
+
+
+if __name__ == "__main__":
+    main()
@@ -38,26 +38,96 @@ optional arguments:
                         Defaults to the current folder.
   -c, --clear-prefs     Clears the existing preferences so that the defaults
                         may be used again.
+  -f {plist,xml,yaml}, --format {plist,xml,yaml}
+                        File format for the recipe: XML plist, binary plist
+                        or YAML. Parent recipes may be in any of these.
+  --prefetch            Prepare the next parent recipe in the background
+                        while questions about the current one are being
+                        answered.
+  --resume              Skip the parent recipes that the journal shows were
+                        completed by a previous run with the same inputs.
+  --journal JOURNAL     Path to the journal of completed parent recipes.
+                        Defaults to .jss_recipe_creator/journal.jsonl in the
+                        destination folder.
+  --dry_run             Report which recipes would be created or changed,
+                        without writing anything.
+  --batch_size BATCH_SIZE
+                        Number of recipes to write at once, all or nothing.
+                        Defaults to 1.
+  --git_commit          Commit the recipes written or changed, and their
+                        icons, to the git repository holding the destination
+                        folder, in a single commit.
+  --provision           After generating recipes, create any categories and
+                        groups they refer to that are missing from the JSS.
+  --on_collision {fail,suffix}
+                        What to do when a recipe's identifier or filename is
+                        already in use: skip the recipe, or append a number.
+  --shard i/N           Only generate the parent recipes in shard i of N, by
+                        a stable hash of their identifiers, and write a
+                        manifest of the results.
+  --manifest MANIFEST   Where to write the manifest. Defaults to
+                        .jss_recipe_creator/shard-i-of-N.plist in the
+                        destination folder when sharding.
+  --merge MANIFEST [MANIFEST ...]
+                        Combine shard manifests into one report, checking for
+                        collisions between shards, and exit.
+  --answers ANSWERS     Where to keep the answers learned from earlier runs,
+                        which fill in questions the template leaves blank.
+  --no_learning         Neither use nor record learned answers.
+  --migrate OLD_TEMPLATE
+                        Update the recipes in the destination folder, which
+                        were made from OLD_TEMPLATE, to the structure of the
+                        recipe template, keeping their values, and exit.
+
+Sharded runs can be tried locally by starting one process per shard,
+e.g. for 1/2 and 2/2, then merging their manifests.
+
+Recipes can also be generated in-process, with no prompting or other
+terminal I/O, using create_recipe() and create_recipes():
+
+    import jss_recipe_creator
+    recipe = jss_recipe_creator.create_recipe(
+        "Firefox.pkg.recipe", {"CATEGORY": "Web Browsers"},
+        template="RecipeTemplate.plist")
+    recipe.write_plist(recipe.answers["Recipe Filename"])
 """
 
 
 from __future__ import absolute_import
 from __future__ import print_function
 import argparse
+import copy
+import difflib
+import hashlib
+import json
 import os.path
+import random
 import readline  # pylint: disable=unused-import
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree
 
-from six.moves import input
+from six.moves import input, queue
+from six.moves.collections_abc import Mapping
 
 # pylint: disable=no-name-in-module
 from Foundation import (NSData,
                         NSPropertyListSerialization,
                         NSPropertyListMutableContainersAndLeaves,
+                        NSPropertyListBinaryFormat_v1_0,
                         NSPropertyListXMLFormat_v1_0)
 # pylint: enable=no-name-in-module
 
+# YAML recipes are optional; PyYAML ships with AutoPkg 2.
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 
 sys.path.insert(0, '/Library/AutoPkg/JSSImporter')
 
@@ -70,6 +140,44 @@ AUTOPKG_PREFERENCES = "~/Library/Preferences/com.github.autopkg.plist"
 PREFERENCES = os.path.expanduser(
     "~/Library/Preferences/com.github.jssimporter.JSSRecipeCreator.plist")
 
+# Client-side throttling of JSS API requests. Each of these may be
+# overridden in the JSSRecipeCreator preferences with the key named in
+# brackets.
+# Requests per second, 0 for unlimited [JSS_Requests_Per_Second].
+JSS_REQUESTS_PER_SECOND = 5
+# Simultaneous requests in flight [JSS_Max_Concurrent_Requests].
+JSS_MAX_CONCURRENT_REQUESTS = 4
+# Retries for 429 and 5xx responses [JSS_Max_Retries].
+JSS_MAX_RETRIES = 5
+# Seconds to reuse a completed GET, 0 to disable [JSS_Cache_TTL].
+JSS_CACHE_TTL = 300
+
+# Threads used to write recipe files [Writer_Threads].
+WRITER_THREADS = 4
+
+# With --git_commit, batches of at least this many files are committed
+# with git fast-import, without going through the index.
+GIT_FAST_IMPORT_THRESHOLD = 1000
+# git before 2.25 can't read pathspecs from stdin, so they're passed on
+# the command line, at most this many at a time.
+GIT_PATHSPEC_FROM_FILE_VERSION = (2, 25)
+GIT_PATHSPEC_CHUNK = 500
+
+# Questions whose answers are learned from earlier runs, and how many
+# distinct answers to remember for each.
+LEARNED_KEYS = ("CATEGORY", "POLICY_CATEGORY", "POLICY_TEMPLATE",
+                "SELF_SERVICE_DESCRIPTION", "groups")
+# The LEARNED_KEYS which are also learned from other products sharing
+# an identifier prefix. Descriptions, policy templates and groups are
+# specific to a product, so are only learned by NAME.
+PREFIX_LEARNED_KEYS = ("CATEGORY", "POLICY_CATEGORY")
+LEARNED_ANSWERS_KEPT = 10
+
+# Format used for JSSRecipeCreator's own caches and state files.
+STATE_FORMAT = "plist"
+# Folder, within the destination folder, for state files.
+STATE_FOLDER = ".jss_recipe_creator"
+
 __version__ = "1.2.0b1"
 
 
@@ -98,6 +206,16 @@ class PlistWriteError(Error):
     pass
 
 
+class CollisionError(Error):
+    """A recipe identifier or filename is already taken."""
+    pass
+
+
+class GitError(Error):
+    """A git command failed."""
+    pass
+
+
 class Plist(dict):
     """Abbreviated plist representation (as a dict)."""
 
@@ -115,12 +233,18 @@ class Plist(dict):
 
     def read_file(self, path):
         """Replace internal XML dict with data from plist at path.
+
+        XML and binary plists are both accepted, as are YAML files
+        (named *.yaml).
+
         Args:
             path: String path to a plist file.
 
         Raises:
             PlistParseError: Error in reading plist file.
         """
+        if path.endswith(".yaml"):
+            return YAMLWriter.read(path)
         # pylint: disable=unused-variable
         try:
             info, pformat, error = (
@@ -136,39 +260,193 @@ class Plist(dict):
                     error = "Invalid plist file."
                 raise PlistParseError("Can't read %s: %s" % (path, error))
         except ValueError:
-            print(("Can't read %s" % (path)))
-            sys.exit()
+            raise PlistParseError("Can't read %s" % (path))
 
         return info
 
-    def write_plist(self, path="."):
+    def write_plist(self, path=".", output_format="xml"):
         """Write plist to path.
 
         Args:
             path: String path to desired plist file.
+            output_format: String key of OUTPUT_WRITERS to write with.
+                Defaults to "xml".
 
         Raises:
             PlistDataError: There was an error in the data.
             PlistWriteError: Plist could not be written.
         """
+        OUTPUT_WRITERS[output_format].write(self, path)
+
+    def serialize(self, output_format="xml"):
+        """Return the bytes that write_plist would write.
+
+        Args:
+            output_format: String key of OUTPUT_WRITERS to use.
+
+        Raises:
+            PlistDataError: There was an error in the data.
+        """
+        return OUTPUT_WRITERS[output_format].serialize(self)
+
+    def new_plist(self):
+        """Generate a barebones recipe plist."""
+        # Not implemented at this time.
+        pass
+
+    def copy(self):
+        """Return a deep copy of this plist, without re-reading it."""
+        duplicate = copy.copy(self)
+        duplicate.update(to_native(self))
+        return duplicate
+
+
+class OutputWriter(object):
+    """Serializes Plist data to one file format.
+
+    Subclasses implement serialize(); add them to OUTPUT_WRITERS to
+    make them available to --format.
+
+    Attributes:
+        extension: String filename extension used for recipes written
+            in this format.
+    """
+    extension = ".recipe"
+
+    @classmethod
+    def serialize(cls, data):
+        """Return data serialized as bytes.
+
+        Raises:
+            PlistDataError: Data can not be represented in this format.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def write(cls, data, path):
+        """Atomically write data to path.
+
+        Raises:
+            PlistDataError: There was an error in the data.
+            PlistWriteError: File could not be written.
+        """
+        cls.write_bytes(cls.serialize(data), path)
+
+    @staticmethod
+    def write_bytes(content, path):
+        """Atomically write already serialized content to path.
+
+        Raises:
+            PlistWriteError: File could not be written.
+        """
+        ns_data = NSData.dataWithBytes_length_(content, len(content))
+        if not ns_data.writeToFile_atomically_(os.path.expanduser(path),
+                                               True):
+            raise PlistWriteError("Failed writing data to %s" % path)
+
+
+class XMLPlistWriter(OutputWriter):
+    """Writes XML property lists."""
+    plist_format = NSPropertyListXMLFormat_v1_0
+
+    @classmethod
+    def serialize(cls, data):
+        """Return data as plist bytes."""
         plist_data, error = NSPropertyListSerialization.dataWithPropertyList_format_options_error_(
-            self,
-            NSPropertyListXMLFormat_v1_0,
+            data,
+            cls.plist_format,
             0,
             None)
         if plist_data is None:
             if error is None:
                 error = "Failed to serialize data to plist."
             raise PlistDataError(error)
-        else:
-            if not plist_data.writeToFile_atomically_(
-                    os.path.expanduser(path), True):
-                raise PlistWriteError("Failed writing data to %s" % path)
+        return bytes(plist_data)
+
+
+class BinaryPlistWriter(XMLPlistWriter):
+    """Writes binary property lists, which are the quickest to parse."""
+    plist_format = NSPropertyListBinaryFormat_v1_0
+
+
+class YAMLWriter(OutputWriter):
+    """Writes AutoPkg-style YAML recipes."""
+    extension = ".recipe.yaml"
+    # AutoPkg's conventional ordering of top-level recipe keys.
+    KEY_ORDER = ("Comment", "Description", "Identifier", "MinimumVersion",
+                 "ParentRecipe", "Input", "Process", "Processor",
+                 "Arguments")
+
+    @classmethod
+    def serialize(cls, data):
+        """Return data as UTF-8 encoded YAML."""
+        cls._require_yaml()
+        try:
+            text = yaml.safe_dump(to_native(data, cls.KEY_ORDER),
+                                  default_flow_style=False,
+                                  allow_unicode=True, sort_keys=False)
+        except yaml.YAMLError as error:
+            raise PlistDataError(error)
+        return text.encode("utf-8")
+
+    @classmethod
+    def read(cls, path):
+        """Return the data from a YAML file.
+
+        Raises:
+            PlistParseError: Error in reading YAML file.
+        """
+        cls._require_yaml()
+        try:
+            with open(os.path.expanduser(path), "rb") as handle:
+                info = yaml.safe_load(handle)
+        except (IOError, yaml.YAMLError) as error:
+            raise PlistParseError("Can't read %s: %s" % (path, error))
+        if not isinstance(info, dict):
+            raise PlistParseError("Can't read %s: Invalid YAML recipe." %
+                                  path)
+        return info
+
+    @staticmethod
+    def _require_yaml():
+        """Raise an Error if PyYAML is not installed."""
+        if yaml is None:
+            raise Error("YAML support requires the PyYAML module.")
 
-    def new_plist(self):
-        """Generate a barebones recipe plist."""
-        # Not implemented at this time.
-        pass
+
+def to_native(data, key_order=()):
+    """Convert (possibly Foundation) containers to plain python.
+
+    Containers are always copied. Dict keys are ordered as in
+    key_order, then alphabetically.
+    """
+    if isinstance(data, Mapping):
+        keys = sorted(data, key=lambda key: (
+            key_order.index(key) if key in key_order else len(key_order),
+            key))
+        # dicts keep insertion order, so yaml will too.
+        return dict((u"%s" % key, to_native(data[key], key_order))
+                    for key in keys)
+    elif isinstance(data, bool):
+        return data
+    elif isinstance(data, (int, float)):
+        return data
+    elif isinstance(data, (bytes, bytearray, NSData)):
+        # <data> values; these are iterable, but not lists.
+        return bytes(data)
+    elif hasattr(data, "encode"):
+        return u"%s" % data
+    elif hasattr(data, "__iter__"):
+        return [to_native(item, key_order) for item in data]
+    return data
+
+
+# Available output formats for --format.
+OUTPUT_WRITERS = {"xml": XMLPlistWriter,
+                  "plist": BinaryPlistWriter,
+                  "yaml": YAMLWriter}
+# Every recipe extension AutoPkg understands, longest first.
+RECIPE_EXTENSIONS = (".recipe.yaml", ".recipe.plist", ".recipe")
 
 
 class Recipe(Plist):
@@ -229,14 +507,27 @@ class JSSRecipe(Recipe):
             filename: String path to a plist file.
         """
         super(JSSRecipe, self).__init__(filename)
+        self.jss_importer = self._find_jss_importer()
+
+    def _find_jss_importer(self):
+        """Return the recipe's (last) JSSImporter processor.
+
+        Raises:
+            PlistDataError: The recipe has no JSSImporter processor.
+        """
         # Ensure a JSSImporter processor has been included in template.
         try:
-            self.jss_importer = [processor for processor in
-                                 self["Process"] if
-                                 processor["Processor"] == "JSSImporter"].pop()
+            return [processor for processor in self["Process"] if
+                    processor["Processor"] == "JSSImporter"].pop()
         except IndexError:
             raise PlistDataError("Recipe template is missing a JSSImporter")
 
+    def copy(self):
+        """Return a deep copy of this recipe, without re-reading it."""
+        duplicate = super(JSSRecipe, self).copy()
+        duplicate.jss_importer = duplicate._find_jss_importer()
+        return duplicate
+
     def new_plist(self, package_only=None):
         """Construct a new, empty JSS recipe.
 
@@ -268,6 +559,7 @@ class JSSRecipe(Recipe):
                                               "self_service_description":
                                                   "%SELF_SERVICE_DESCRIPTION%",
                                               "groups": []}}]
+        self.jss_importer = self["Process"][0]
 
     def add_scoping_group(self, group):
         """Add a group to the scope if it's not already included.
@@ -328,6 +620,649 @@ class JSSRecipe(Recipe):
                 self.add_scoping_group(group)
 
 
+class RecipeIndex(object):
+    """Hash index of recipe identifiers and paths.
+
+    Seeded once from the destination folder and the AutoPkg recipe
+    search dirs, then updated as recipes are generated, so that
+    identifier and filename collisions can be found at the moment a
+    new recipe claims them, without rescanning the filesystem.
+
+    Attributes:
+        identifiers: Dict mapping identifier to recipe path.
+        paths: Dict mapping normalized recipe path to identifier.
+    """
+    def __init__(self):
+        self.identifiers = {}
+        self.paths = {}
+        self._claimed = set()
+
+    def seed(self, folders):
+        """Add every recipe found beneath folders to the index.
+
+        Unreadable recipes are skipped; AutoPkg would not be able to
+        use them either.
+
+        Args:
+            folders: Iterable of string folder paths.
+        """
+        for path in find_recipes(folders):
+            try:
+                identifier = Plist(path).get("Identifier")
+            except Error:
+                continue
+            if identifier:
+                self.add(identifier, path)
+
+    def add(self, identifier, path):
+        """Record an existing recipe without checking for collisions."""
+        self.identifiers.setdefault(identifier, path)
+        self.paths.setdefault(normalize_path(path), identifier)
+
+    def claim(self, identifier, path, suffix=False):
+        """Reserve an identifier and output path for a new recipe.
+
+        A recipe may replace the file that already holds its own
+        identifier; anything else already indexed, or claimed earlier
+        in this run, is a collision.
+
+        Args:
+            identifier: String recipe identifier.
+            path: String path the recipe will be written to.
+            suffix: Bool. If True, resolve collisions by appending
+                "-2", "-3", etc. to the identifier and filename
+                rather than raising.
+
+        Returns:
+            Tuple of (identifier, path) actually reserved.
+
+        Raises:
+            CollisionError: The identifier or path is taken and
+                suffix is False.
+        """
+        conflict = self._conflict(identifier, path)
+        count = 1
+        new_identifier, new_path = identifier, path
+        while conflict:
+            if not suffix:
+                raise CollisionError(conflict)
+            count += 1
+            new_identifier = "%s-%d" % (identifier, count)
+            stem, extension = split_recipe_extension(path)
+            new_path = "%s-%d%s" % (stem, count, extension)
+            conflict = self._conflict(new_identifier, new_path)
+
+        key = normalize_path(new_path)
+        self.identifiers[new_identifier] = new_path
+        self.paths[key] = new_identifier
+        self._claimed.add(key)
+        return new_identifier, new_path
+
+    def _conflict(self, identifier, path):
+        """Return a description of any collision, or None."""
+        key = normalize_path(path)
+        if key in self._claimed:
+            return "%s has already been written during this run." % path
+        owner = self.paths.get(key)
+        if owner is not None and owner != identifier:
+            return "%s already holds recipe %s." % (path, owner)
+        location = self.identifiers.get(identifier)
+        if location is not None and normalize_path(location) != key:
+            return "Identifier %s is already used by %s." % (identifier,
+                                                            location)
+        return None
+
+
+class Manifest(Plist):
+    """Record of the recipes one run (or shard) generated.
+
+    Shards each write a manifest; merge_manifests() combines them and
+    checks for collisions between shards.
+    """
+
+    def new_plist(self):
+        """Generate an empty manifest."""
+        self["Version"] = __version__
+        self["Shard"] = 1
+        self["Shards"] = 1
+        self["Recipes"] = []
+        self["Skipped"] = []
+
+    def add_recipe(self, parent, parent_identifier, identifier, filename):
+        """Record a generated recipe.
+
+        Args:
+            parent: String path to the parent recipe.
+            parent_identifier: String identifier of the parent recipe.
+            identifier: String identifier of the new recipe.
+            filename: String path of the new recipe, relative to the
+                destination folder.
+        """
+        self["Recipes"].append({"ParentRecipe": parent,
+                                "ParentIdentifier": parent_identifier,
+                                "Identifier": identifier,
+                                "Filename": filename})
+
+    def add_skipped(self, parent, reason):
+        """Record a parent recipe which did not produce a recipe."""
+        self["Skipped"].append({"ParentRecipe": parent,
+                                "Reason": u"%s" % reason})
+
+    def write_plist(self, path=".", output_format=STATE_FORMAT):
+        """Write the manifest, creating its folder if needed."""
+        folder = os.path.dirname(os.path.expanduser(path))
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        super(Manifest, self).write_plist(path, output_format)
+
+
+class AnswerStore(Plist):
+    """Counts of the answers given in earlier runs.
+
+    Answers are counted by parent recipe NAME and, for the
+    PREFIX_LEARNED_KEYS, by identifier prefix (e.g. "com.github.foo."),
+    so each lookup is a couple of dict lookups however many recipes
+    have been recorded. The most frequent answers fill in questions
+    which the template leaves blank, with answers for the same NAME
+    taking precedence over those for the same prefix.
+
+    Lookups may run on a --prefetch thread while answers are recorded,
+    so both hold a lock.
+    """
+
+    def __init__(self, path):
+        """Load the store at path, or start a new one.
+
+        Raises:
+            PlistParseError: The store exists, but can't be read.
+        """
+        self._lock = threading.Lock()
+        self.path = os.path.expanduser(path)
+        super(AnswerStore, self).__init__(
+            self.path if os.path.exists(self.path) else None)
+        dict.update(self, to_native(self))
+
+    def new_plist(self):
+        """Generate an empty store."""
+        self["Version"] = __version__
+        self["Names"] = {}
+        self["Prefixes"] = {}
+
+    def record(self, results):
+        """Count the answers for one recipe.
+
+        Args:
+            results: Dict of results, as Menu.results.
+        """
+        # Templated groups may still be Foundation objects.
+        answers = dict((question, json.dumps(to_native(results[question]),
+                                             sort_keys=True))
+                       for question in LEARNED_KEYS if results.get(question))
+        with self._lock:
+            for table, key, questions in self._keys(results["ParentRecipe"],
+                                                    results["NAME"]):
+                learned = self[table].setdefault(key, {})
+                for question, answer in answers.items():
+                    if question not in questions:
+                        continue
+                    counts = learned.setdefault(question, {})
+                    counts[answer] = counts.get(answer, 0) + 1
+                    # Forget the rarest answer, but never the latest.
+                    if len(counts) > LEARNED_ANSWERS_KEPT:
+                        del counts[min((item for item in counts if
+                                        item != answer), key=counts.get)]
+
+    def defaults(self, parent_identifier, name):
+        """Return the most frequent answers for a parent recipe.
+
+        Returns:
+            Dict mapping LEARNED_KEYS to answers.
+        """
+        results = {}
+        with self._lock:
+            # Later tables override earlier ones.
+            for table, key, questions in reversed(
+                    self._keys(parent_identifier, name)):
+                for question, counts in self[table].get(key, {}).items():
+                    # Stores from earlier versions learned every
+                    # question by prefix.
+                    if question not in questions:
+                        continue
+                    results[question] = json.loads(
+                        max(sorted(counts), key=counts.get))
+        return results
+
+    def apply(self, recipe, parent_recipe, name):
+        """Fill in the recipe template's blanks with learned answers.
+
+        Args:
+            recipe: JSSRecipe to populate.
+            parent_recipe: Recipe of its parent.
+            name: String NAME of the parent recipe.
+        """
+        learned = self.defaults(parent_recipe["Identifier"], name)
+        for key in LEARNED_KEYS:
+            if key in learned and recipe["Input"].get(key) == "":
+                recipe["Input"][key] = learned[key]
+        if "groups" in recipe.jss_importer["Arguments"]:
+            for group in learned.get("groups", []):
+                recipe.add_scoping_group(group)
+
+    def write_plist(self, path=None, output_format=STATE_FORMAT):
+        """Write the store, by default to where it was loaded from."""
+        path = path or self.path
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self._lock:
+            super(AnswerStore, self).write_plist(path, output_format)
+
+    @staticmethod
+    def _keys(parent_identifier, name):
+        """Return (table, key, questions) to file answers under."""
+        return [("Names", name, LEARNED_KEYS),
+                ("Prefixes", identifier_prefix(parent_identifier),
+                 PREFIX_LEARNED_KEYS)]
+
+
+class BatchWriter(object):
+    """Writes a batch of files atomically: all of them, or none.
+
+    Files are serialized up front and compared with what is already on
+    disk, so unchanged files are never rewritten. On commit, temporary
+    files are written and synced by a pool of threads; only once all of
+    them have succeeded are they renamed into place, followed by one
+    sync per folder. If a rename fails, files already replaced are
+    restored to their previous contents.
+
+    Attributes:
+        workers: Int number of writer threads.
+        dry_run: Bool. If True, commit() only reports what would change.
+    """
+    NEW = "new"
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+
+    def __init__(self, workers=WRITER_THREADS, dry_run=False):
+        self.workers = workers
+        self.dry_run = dry_run
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, path, content):
+        """Queue content (bytes) to be written to path.
+
+        Returns:
+            NEW, CHANGED or UNCHANGED.
+        """
+        path = os.path.expanduser(path)
+        try:
+            with open(path, "rb") as handle:
+                old_content = handle.read()
+        except IOError:
+            old_content = None
+        if old_content is None:
+            status = self.NEW
+        elif old_content == content:
+            status = self.UNCHANGED
+        else:
+            status = self.CHANGED
+        self._pending.append((path, content, old_content, status))
+        return status
+
+    def commit(self):
+        """Write every queued file, or none of them.
+
+        Returns:
+            Dict mapping each queued path to its status.
+
+        Raises:
+            PlistWriteError: Nothing was written (or everything was
+                restored) because a file could not be written.
+        """
+        pending, self._pending = self._pending, []
+        statuses = dict((path, status) for path, _, _, status in pending)
+        for path, _, _, status in pending:
+            if self.dry_run:
+                print("Would %s %s" % (
+                    {self.NEW: "create", self.CHANGED: "update",
+                     self.UNCHANGED: "leave unchanged"}[status], path))
+            elif status == self.UNCHANGED:
+                print("%s is unchanged." % path)
+            else:
+                print("Writing to %s" % path)
+        to_write = [item for item in pending if item[3] != self.UNCHANGED]
+        if self.dry_run or not to_write:
+            return statuses
+
+        results = parallel_map(self._write_temp, to_write, self.workers)
+        errors = [result for result in results if
+                  isinstance(result, EnvironmentError)]
+        if errors:
+            for result in results:
+                if not isinstance(result, EnvironmentError):
+                    os.remove(result)
+            raise PlistWriteError("Nothing written: %s" % errors[0])
+
+        done = []
+        try:
+            for (path, _, old_content, _), temp_path in zip(to_write,
+                                                            results):
+                os.rename(temp_path, path)
+                done.append((path, old_content))
+        except EnvironmentError as error:
+            self._roll_back(done, results[len(done):])
+            raise PlistWriteError("Nothing written: %s" % error)
+
+        for folder in set(os.path.dirname(path) for path, _ in done):
+            fsync_folder(folder)
+        return statuses
+
+    @staticmethod
+    def _write_temp(item):
+        """Write and sync a temp file next to its destination.
+
+        Returns:
+            The temp file's path, or the EnvironmentError raised.
+        """
+        path, content = item[:2]
+        try:
+            handle, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path) or os.curdir,
+                prefix=".%s." % os.path.basename(path))
+            try:
+                os.write(handle, content)
+                os.fsync(handle)
+            finally:
+                os.close(handle)
+            # mkstemp makes files only we can read.
+            os.chmod(temp_path, 0o644)
+        except EnvironmentError as error:
+            return error
+        return temp_path
+
+    @staticmethod
+    def _roll_back(done, temp_paths):
+        """Restore replaced files and discard unused temp files."""
+        for temp_path in temp_paths:
+            try:
+                os.remove(temp_path)
+            except EnvironmentError:
+                pass
+        for path, old_content in done:
+            try:
+                if old_content is None:
+                    os.remove(path)
+                else:
+                    OutputWriter.write_bytes(old_content, path)
+            except (EnvironmentError, Error):
+                print("Could not restore %s!" % path)
+
+
+class TemplateDelta(object):
+    """The structural changes between two versions of a recipe template.
+
+    Computed once, then applied to any number of recipes made from the
+    old template. Keys the new template adds are added where missing,
+    and keys it drops are removed. Changed values are only updated
+    where a recipe still has the old template's value, and never for
+    the values update_recipe() sets, so answers and hand edits survive.
+    List items (e.g. scoping groups) are added and removed one by one,
+    and processors are matched by name rather than position.
+
+    Attributes:
+        changes: List of (action, path, old, new) tuples. path is a
+            tuple of keys, naming processors by their Processor. For
+            an added processor, old is the name of the processor it
+            follows (or None).
+    """
+    ADD = "Add"
+    REMOVE = "Remove"
+    CHANGE = "Change"
+    ADD_ITEM = "Add item to"
+    REMOVE_ITEM = "Remove item from"
+    # Set for each recipe by update_recipe().
+    RECIPE_VALUES = ((("Identifier",), ("ParentRecipe",), ("Description",),
+                      ("MinimumVersion",), ("Comment",)) +
+                     tuple(("Input", key) for key in (
+                         "NAME", "CATEGORY", "POLICY_CATEGORY",
+                         "POLICY_TEMPLATE", "SELF_SERVICE_ICON",
+                         "SELF_SERVICE_DESCRIPTION")))
+
+    def __init__(self, old_template, new_template):
+        """Compare two templates.
+
+        Args:
+            old_template: Recipe (or dict) the recipes were made from.
+            new_template: Recipe (or dict) to migrate them to.
+        """
+        self.changes = []
+        self._compare(to_native(old_template), to_native(new_template), ())
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __str__(self):
+        lines = []
+        for action, path, old, new in self.changes:
+            if action in (self.REMOVE, self.REMOVE_ITEM):
+                value = old
+            elif action == self.CHANGE:
+                value = "%r -> %r" % (old, new)
+            else:
+                value = new
+            lines.append("%s %s: %s" % (action, "/".join(path), value))
+        return "\n".join(lines)
+
+    def _compare(self, old, new, path):
+        """Record the changes from old to new, found at path."""
+        if isinstance(old, list) and isinstance(new, list):
+            old_processors = self._by_processor(old)
+            new_processors = self._by_processor(new)
+            if old_processors is not None and new_processors is not None:
+                names = list(new_processors)
+                for index, name in enumerate(names):
+                    if name not in old_processors:
+                        previous = names[index - 1] if index else None
+                        self.changes.append((self.ADD, path + (name,),
+                                             previous, new_processors[name]))
+                old, new = old_processors, new_processors
+            else:
+                self.changes.extend((self.REMOVE_ITEM, path, item, None) for
+                                    item in old if item not in new)
+                self.changes.extend((self.ADD_ITEM, path, None, item) for
+                                    item in new if item not in old)
+                return
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in new:
+                if key in old:
+                    self._compare(old[key], new[key], path + (key,))
+                elif not isinstance(new, _Processors):
+                    self.changes.append((self.ADD, path + (key,), None,
+                                         new[key]))
+            self.changes.extend((self.REMOVE, path + (key,), old[key], None)
+                                for key in old if key not in new)
+        elif old != new:
+            self.changes.append((self.CHANGE, path, old, new))
+
+    @staticmethod
+    def _by_processor(items):
+        """Return processors keyed by name, or None for other lists."""
+        if items and all(isinstance(item, dict) and "Processor" in item for
+                         item in items):
+            return _Processors((item["Processor"], item) for item in items)
+        return None
+
+    def apply(self, recipe):
+        """Return a migrated copy of recipe, as plain python."""
+        result = to_native(recipe)
+        for action, path, old, new in self.changes:
+            if action in (self.ADD_ITEM, self.REMOVE_ITEM):
+                items = self._find(result, path)
+                if not isinstance(items, list):
+                    continue
+                if action == self.ADD_ITEM and new not in items:
+                    items.append(to_native(new))
+                elif action == self.REMOVE_ITEM:
+                    items[:] = [item for item in items if item != old]
+                continue
+
+            parent = self._find(result, path[:-1])
+            key = path[-1]
+            if isinstance(parent, list):
+                names = [item.get("Processor") for item in parent]
+                if action == self.ADD and key not in names:
+                    if old is None:
+                        index = 0
+                    elif old in names:
+                        index = names.index(old) + 1
+                    else:
+                        index = len(names)
+                    parent.insert(index, to_native(new))
+                elif action == self.REMOVE:
+                    parent[:] = [item for item in parent if
+                                 item.get("Processor") != key]
+            elif isinstance(parent, dict):
+                if action == self.ADD:
+                    parent.setdefault(key, to_native(new))
+                elif action == self.REMOVE:
+                    parent.pop(key, None)
+                elif (path not in self.RECIPE_VALUES and key in parent and
+                      parent[key] == old):
+                    parent[key] = to_native(new)
+        return result
+
+    @staticmethod
+    def _find(data, path):
+        """Return the value at path in data, or None."""
+        for key in path:
+            if isinstance(data, list):
+                data = ([item for item in data if isinstance(item, dict) and
+                         item.get("Processor") == key] or [None])[-1]
+            elif isinstance(data, dict):
+                data = data.get(key)
+            else:
+                return None
+        return data
+
+
+class _Processors(dict):
+    """A recipe's processors, keyed by name (for TemplateDelta)."""
+    pass
+
+
+class Journal(object):
+    """Append-only record of the parent recipes a run has completed.
+
+    Each completed parent is written as one line of JSON, recording
+    hashes of its inputs and the recipe it produced, and is flushed to
+    disk before the next parent is started. A run which dies can then
+    be resumed without redoing that work.
+
+    Parents are identified by absolute path, so a run can be resumed
+    from another folder, or with the parents spelled differently.
+
+    Attributes:
+        path: String path to the journal file.
+        entries: Dict mapping absolute parent path to its latest entry.
+    """
+
+    def __init__(self, path, resume=False, read_only=False):
+        """Open a journal, starting a new one unless resuming.
+
+        Args:
+            path: String path to the journal file.
+            resume: Bool. If True, load and keep the existing entries;
+                otherwise the journal is emptied.
+            read_only: Bool. If True, leave the file untouched and only
+                record entries in memory (e.g. for dry runs).
+        """
+        self.path = os.path.expanduser(path)
+        self.entries = {}
+        self._handle = None
+        if resume and os.path.exists(self.path):
+            with open(self.path) as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn final line from a crash mid-write.
+                        continue
+                    self.entries[self._key(entry["ParentRecipe"])] = entry
+        if not read_only:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._handle = open(self.path, "a" if resume else "w")
+
+    def completed(self, parent, hashes):
+        """Return the entry for parent if it's done and unchanged.
+
+        Args:
+            parent: String path to the parent recipe.
+            hashes: Dict of input hashes, as from input_hashes().
+
+        Returns:
+            The entry dict, or None if parent must be (re)generated.
+        """
+        entry = self.entries.get(self._key(parent))
+        if (entry and entry["Inputs"] == hashes and
+                os.path.exists(os.path.expanduser(entry["Output"]))):
+            return entry
+        return None
+
+    def record(self, parent, hashes, **details):
+        """Durably append a completed parent to the journal.
+
+        Args:
+            parent: String path to the parent recipe.
+            hashes: Dict of input hashes, as from input_hashes().
+            details: Other items to store, e.g. Output, the path to the
+                generated recipe.
+        """
+        entry = dict(details, ParentRecipe=self._key(parent), Inputs=hashes)
+        if "Output" in entry:
+            # Stored absolute, so it's found whatever the working
+            # folder, and however the destination was given.
+            entry["Output"] = os.path.abspath(os.path.expanduser(
+                entry["Output"]))
+        if self._handle:
+            self._handle.write(json.dumps(entry, sort_keys=True) + "\n")
+            self._handle.flush()
+            # fdatasync skips the metadata flush where the OS offers it.
+            getattr(os, "fdatasync", os.fsync)(self._handle.fileno())
+        self.entries[self._key(parent)] = entry
+
+    def close(self):
+        """Close the journal file."""
+        if self._handle:
+            self._handle.close()
+
+    @staticmethod
+    def _key(parent):
+        """Return the key an entry for parent is filed under."""
+        return os.path.abspath(os.path.expanduser(parent))
+
+    @staticmethod
+    def input_hashes(parent, template, options, answers=None):
+        """Return a dict of hashes of everything a recipe depends on.
+
+        Args:
+            parent: String path to the parent recipe.
+            template: String path to the recipe template, or None.
+            options: JSON-serializable value of any other settings
+                which affect the output, e.g. the preferences.
+            answers: JSON-serializable dict of the answers given ahead
+                of asking, e.g. the learned answers for this parent.
+        """
+        return {"ParentRecipe": file_hash(parent),
+                "Template": file_hash(template) if template else "",
+                "Options": json_hash(options),
+                "Answers": json_hash(answers or {})}
+
+
 class Menu(object):
     """Presents users with a menu and handles their input.
 
@@ -353,14 +1288,7 @@ class Menu(object):
                 default values.
         """
         for submenu in self.submenus:
-            while True:
-                try:
-                    result = submenu.ask(auto=auto)
-                    break
-                except ChoiceError:
-                    print("\n**Invalid entry! Try again.**")
-                    continue
-            self.results.update(result)
+            self.results.update(ask_until_valid(submenu, auto))
 
     def add_submenu(self, submenu):
         """Add a Submenu to our questions list.
@@ -500,11 +1428,7 @@ class ScopeSubmenu(Submenu):
         # templated groups to add to it.
         # Entries should be a dict of name, smart, and
         # template_path values.
-        self.results = []
-        if "groups" in list(recipe_template.jss_importer["Arguments"].keys()):
-            templated_groups = recipe_template.jss_importer["Arguments"].get(
-                "groups")
-            self.results.extend(templated_groups)
+        self.results = templated_groups(recipe_template)
 
     def ask(self, auto=False):
         """Ask user about scoping based on configured values.
@@ -617,19 +1541,7 @@ class ScopeSubmenu(Submenu):
             JSSRecipe.SMART_GROUP if group is smart, or None if group
             doesn't exist.
         """
-        try:
-            group = self.j.ComputerGroup(name)
-        except jss.exceptions.GetError:
-            group = None
-
-        if group is None:
-            result = None
-        elif group.findtext("is_smart") == "true":
-            result = self.SMART_GROUP
-        else:
-            result = self.STATIC_GROUP
-
-        return result
+        return check_group(self.j, name)
 
     def display_results(self):
         """Pretty print current results."""
@@ -642,6 +1554,239 @@ class ScopeSubmenu(Submenu):
                               result])))
 
 
+class JSSRequestScheduler(object):
+    """Throttles, coalesces and retries python-jss object requests.
+
+    Wraps a jss.JSS object so that it can be used in its place. Calls
+    to the object search methods (e.g. Category(), ComputerGroup(name))
+    are routed through the scheduler; everything else is passed
+    straight through to the wrapped JSS.
+
+    Identical requests made while one is already in flight wait for,
+    and share, its result rather than hitting the JSS again. Requests
+    are limited to a steady rate and a maximum number in flight, and
+    are retried with jittered exponential backoff when the JSS answers
+    with a 429 or 5xx status.
+
+    Attributes:
+        j: The wrapped jss.JSS object.
+        requests_per_second: Float maximum request rate (0 = no limit).
+        max_retries: Int number of retries for throttled/failed calls.
+        cache_ttl: Int seconds to reuse a completed result.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 30.0
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, j, requests_per_second=JSS_REQUESTS_PER_SECOND,
+                 max_concurrency=JSS_MAX_CONCURRENT_REQUESTS,
+                 max_retries=JSS_MAX_RETRIES, cache_ttl=JSS_CACHE_TTL):
+        """Set up a scheduler for a JSS.
+
+        Args:
+            j: A python-jss JSS object.
+            requests_per_second: Number of requests allowed per second.
+                Use 0 for no limit.
+            max_concurrency: Int number of requests allowed in flight
+                at once.
+            max_retries: Int number of times to retry a request which
+                was throttled or failed on the server side.
+            cache_ttl: Int seconds for which a completed request's
+                result will be reused. Use 0 to disable.
+        """
+        self.j = j
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.cache_ttl = cache_ttl
+        self._concurrency = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._next_slot = 0.0
+        self._in_flight = {}
+        self._cache = {}
+    # pylint: enable=too-many-arguments
+
+    @classmethod
+    def from_preferences(cls, j, env):
+        """Create a scheduler configured from JSSRecipeCreator prefs.
+
+        Args:
+            j: A python-jss JSS object.
+            env: Dict of JSSRecipeCreator preferences.
+        """
+        return cls(
+            j,
+            requests_per_second=float(env.get("JSS_Requests_Per_Second",
+                                              JSS_REQUESTS_PER_SECOND)),
+            max_concurrency=int(env.get("JSS_Max_Concurrent_Requests",
+                                        JSS_MAX_CONCURRENT_REQUESTS)),
+            max_retries=int(env.get("JSS_Max_Retries", JSS_MAX_RETRIES)),
+            cache_ttl=int(env.get("JSS_Cache_TTL", JSS_CACHE_TTL)))
+
+    def __getattr__(self, name):
+        """Route object search methods through the scheduler."""
+        attr = getattr(self.j, name)
+        if not (callable(attr) and name[:1].isupper()):
+            return attr
+
+        def scheduled(*args, **kwargs):
+            """Make a scheduled request to the wrapped JSS."""
+            if kwargs:
+                # Keyword searches are not worth coalescing; just
+                # throttle them.
+                return self.perform(attr, *args, **kwargs)
+            return self.request(name, *args)
+        return scheduled
+
+    def request(self, method, *args):
+        """GET an object or listing, sharing identical requests.
+
+        Args:
+            method: String name of the JSS search method (e.g.
+                "ComputerGroup").
+            args: Hashable positional args for that method.
+
+        Returns:
+            Whatever the JSS search method returns.
+
+        Raises:
+            Any error raised by python-jss once retries are exhausted.
+        """
+        key = (method, args)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and time.time() - cached[0] < self.cache_ttl:
+                return cached[1]
+            pending = self._in_flight.get(key)
+            owner = pending is None
+            if owner:
+                pending = _PendingRequest()
+                self._in_flight[key] = pending
+
+        if not owner:
+            return pending.wait()
+
+        completed = False
+        try:
+            pending.result = self.perform(getattr(self.j, method), *args)
+            completed = True
+        except BaseException as error:  # pylint: disable=broad-except
+            # Including interruptions: waiters must not mistake an
+            # unfinished request for a None result.
+            pending.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if completed and self.cache_ttl:
+                    self._cache[key] = (time.time(), pending.result)
+            pending.event.set()
+        return pending.result
+
+    def perform(self, func, *args, **kwargs):
+        """Call func within the rate and concurrency budget.
+
+        Retries with jittered exponential backoff if the JSS responds
+        with one of RETRY_STATUSES.
+        """
+        attempt = 0
+        while True:
+            self._wait_for_slot()
+            try:
+                with self._concurrency:
+                    return func(*args, **kwargs)
+            except jss.exceptions.JSSError as error:
+                if (attempt >= self.max_retries or
+                        get_status_code(error) not in self.RETRY_STATUSES):
+                    raise
+            delay = random.uniform(
+                0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+            time.sleep(delay)
+            attempt += 1
+
+    def invalidate(self, method=None):
+        """Forget cached results, optionally only for one method."""
+        with self._lock:
+            if method is None:
+                self._cache.clear()
+            else:
+                for key in [key for key in self._cache if key[0] == method]:
+                    del self._cache[key]
+
+    def _wait_for_slot(self):
+        """Block until the rate limit allows another request."""
+        if not self.requests_per_second:
+            return
+        with self._rate_lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.requests_per_second
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BackgroundTask(object):
+    """Run a function on a daemon thread and collect its result."""
+
+    def __init__(self, func, *args, **kwargs):
+        """Start running func(*args).
+
+        Args:
+            func: Callable to run.
+            args: Positional args for func.
+            start: Bool. If False (keyword only), func is not run until
+                result() is called, in the calling thread.
+        """
+        self.func = func
+        self.args = args
+        self._result = None
+        self._error = None
+        self._thread = None
+        if kwargs.get("start", True):
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        """Call func, storing its result or error."""
+        try:
+            self._result = self.func(*self.args)
+        except BaseException as error:  # pylint: disable=broad-except
+            self._error = error
+
+    def result(self):
+        """Wait for func to finish and return its result.
+
+        Raises:
+            Whatever func raised.
+        """
+        if self._thread is None:
+            self._thread = threading.current_thread()
+            self._run()
+        elif self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _PendingRequest(object):
+    """A request in flight which other callers may wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """Wait for the request to finish and return its result."""
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 def configure_jss(env):
     """Configure a JSS object based on JSSRecipeCreator's env.
 
@@ -662,7 +1807,8 @@ def configure_jss(env):
     return j
 
 
-def build_menu(j, parent_recipe, recipe, parent_filename, env, package_only):
+def build_menu(j, parent_recipe, recipe, parent_filename, env, package_only,
+               output_format="xml"):
     """Construct the menu for prompting users to create a JSS recipe.
 
     Args:
@@ -673,6 +1819,8 @@ def build_menu(j, parent_recipe, recipe, parent_filename, env, package_only):
         args: Arguments returned from argparser.
         env: JSSRecipeCreator preferences dict.
         package_only: boolean, set a package-only recipe
+        output_format: String key of OUTPUT_WRITERS the recipe will be
+            written with; determines the filename extension.
 
     Returns:
         A Menu with all questions configured and ready to ask().
@@ -683,65 +1831,31 @@ def build_menu(j, parent_recipe, recipe, parent_filename, env, package_only):
     """
     menu = Menu()
 
-    # set different recipe types (currently .jss and .jss-upload)
-    if package_only:
-        replacement_recipe_type = ".jss-upload."
-    else:
-        replacement_recipe_type = ".jss."
+    default_filename, default_recipe_id, parent_recipe_name = recipe_names(
+        parent_recipe, parent_filename, package_only, output_format)
 
     # Filename.
-    if not "PKG.RECIPE" in parent_filename.upper():
-        raise AttributeError("Recipe must be based on a package recipe!")
-
-    default_filename = os.path.basename(
-        parent_filename.replace(".pkg.", replacement_recipe_type))
     menu.add_submenu(Submenu("Recipe Filename", default_filename, False,
                              default=default_filename))
 
     # Identifier
-    parent_recipe_id = parent_recipe["Identifier"]
-    default_recipe_id = parent_recipe_id.replace(
-        ".pkg.", replacement_recipe_type)
     menu.add_submenu(Submenu("Identifier", default_recipe_id, False,
                              default=default_recipe_id,
                              heading="Recipe Identifier"))
 
-    # Parent Recipe
-    menu.results["ParentRecipe"] = parent_recipe["Identifier"]
-
     # NAME
-    parent_recipe_name = parent_recipe["Input"].get("NAME", "")
-    if not parent_recipe_name:
-        parent_recipe_name = parent_recipe_id.split('.')[-1]
     menu.add_submenu(Submenu("NAME", parent_recipe_name, False,
                              default=parent_recipe_name))
 
-    # Description, Min version.
-    # Append a JSS recipe description to the parent's string.
-    menu.results["Description"] = (parent_recipe.get(
-        "Description", "Builds a package of %s." %
-        parent_recipe_name) + env.get("Default_Recipe_Desc_PS", ""))
-
-    # Use the parent's Minimum version since JSSImporter has no extra
-    # version requirements.
-    menu.results["MinimumVersion"] = parent_recipe.get("MinimumVersion",
-                                                       "1.0.0")
+    # Parent Recipe, Description, Min version.
+    menu.results.update(recipe_metadata(parent_recipe, parent_recipe_name,
+                                        env))
 
     # Policy Template (not used in package only recipe)
     if not package_only:
-        policy_template_options = [template for template in os.listdir(os.curdir)
-                                   if "XML" in
-                                   os.path.splitext(template)[1].upper()]
-
-        # Check for a value supplied in the template; then fall back to the
-        # global from above, and barring that, use "".
-        if recipe["Input"].get("POLICY_TEMPLATE"):
-            policy_template_default = recipe["Input"]["POLICY_TEMPLATE"]
-        elif (env.get("Default_Policy_Template") and
-              env["Default_Policy_Template"] in policy_template_options):
-            policy_template_default = env["Default_Policy_Template"]
-        else:
-            policy_template_default = ""
+        policy_template_options = list_templates()
+        policy_template_default = default_policy_template(
+            recipe, env, lambda: policy_template_options)
         menu.add_submenu(Submenu("POLICY_TEMPLATE", policy_template_options, True,
                                  default=policy_template_default,
                                  heading="Policy Template"))
@@ -765,10 +1879,7 @@ def build_menu(j, parent_recipe, recipe, parent_filename, env, package_only):
     # Icon (We only use png).
     if not package_only:
         icon_default = parent_recipe["Input"].get("NAME", "Icon") + ".png"
-        icon_options = [icon for icon in os.listdir(os.curdir) if
-                        "PNG" in os.path.splitext(icon)[1].upper()]
-        if icon_default not in icon_options:
-            icon_options.append(icon_default)
+        icon_options = list_icons(icon_default)
         menu.add_submenu(Submenu("SELF_SERVICE_ICON", icon_options, True,
                                  default=icon_default,
                                  heading="Self Service Icon"))
@@ -785,17 +1896,374 @@ def build_menu(j, parent_recipe, recipe, parent_filename, env, package_only):
     return menu
 
 
-def build_argparser(env):
-    """Create JSSRecipeCreator argument parser.
+def recipe_names(parent_recipe, parent_filename, package_only,
+                 output_format="xml"):
+    """Work out the default filename, identifier and NAME for a recipe.
 
     Args:
-        env: Dict of JSSRecipeCreator preferences.
+        parent_recipe: Recipe of the desired parent recipe.
+        parent_filename: String path to the parent recipe.
+        package_only: boolean, set a package-only recipe
+        output_format: String key of OUTPUT_WRITERS the recipe will be
+            written with; determines the filename extension.
 
     Returns:
-        Configured ArgumentParser.
-    """
-    parser = argparse.ArgumentParser(description="Quickly generate JSS "
-                                     "recipes.")
+        Tuple of strings (filename, identifier, NAME).
+
+    Raises:
+        AttributeError: If a non-pkg recipe is provided as the parent,
+            as a pkg is required for policy installs.
+    """
+    # set different recipe types (currently .jss and .jss-upload)
+    if package_only:
+        replacement_recipe_type = ".jss-upload."
+    else:
+        replacement_recipe_type = ".jss."
+
+    if not "PKG.RECIPE" in parent_filename.upper():
+        raise AttributeError("Recipe must be based on a package recipe!")
+
+    default_filename = recipe_filename(
+        os.path.basename(parent_filename.replace(".pkg.",
+                                                 replacement_recipe_type)),
+        output_format)
+
+    parent_recipe_id = parent_recipe["Identifier"]
+    default_recipe_id = parent_recipe_id.replace(
+        ".pkg.", replacement_recipe_type)
+
+    parent_recipe_name = parent_recipe["Input"].get("NAME", "")
+    if not parent_recipe_name:
+        parent_recipe_name = parent_recipe_id.split('.')[-1]
+
+    return default_filename, default_recipe_id, parent_recipe_name
+
+
+def recipe_metadata(parent_recipe, parent_recipe_name, env):
+    """Return the answers which are never asked about.
+
+    Returns:
+        Dict with ParentRecipe, Description and MinimumVersion.
+    """
+    return {
+        "ParentRecipe": parent_recipe["Identifier"],
+        # Append a JSS recipe description to the parent's string.
+        "Description": (parent_recipe.get(
+            "Description", "Builds a package of %s." %
+            parent_recipe_name) + env.get("Default_Recipe_Desc_PS", "")),
+        # Use the parent's Minimum version since JSSImporter has no
+        # extra version requirements.
+        "MinimumVersion": parent_recipe.get("MinimumVersion", "1.0.0")}
+
+
+def default_policy_template(recipe, env, get_options):
+    """Return the default policy template.
+
+    Check for a value supplied in the template; then fall back to the
+    preferences (if that file is available), and barring that, use "".
+
+    Args:
+        recipe: JSSRecipe being populated.
+        env: JSSRecipeCreator preferences dict.
+        get_options: Callable returning the available templates. Only
+            called if needed.
+    """
+    if recipe["Input"].get("POLICY_TEMPLATE"):
+        return recipe["Input"]["POLICY_TEMPLATE"]
+    elif (env.get("Default_Policy_Template") and
+          env["Default_Policy_Template"] in get_options()):
+        return env["Default_Policy_Template"]
+    return ""
+
+
+def list_templates():
+    """Return the XML templates in the current folder."""
+    return [template for template in os.listdir(os.curdir)
+            if "XML" in os.path.splitext(template)[1].upper()]
+
+
+def list_icons(icon_default):
+    """Return the PNG icons in the current folder, plus a default."""
+    icon_options = [icon for icon in os.listdir(os.curdir) if
+                    "PNG" in os.path.splitext(icon)[1].upper()]
+    if icon_default not in icon_options:
+        icon_options.append(icon_default)
+    return icon_options
+
+
+def templated_groups(recipe):
+    """Return a new list of the scoping groups in a recipe template."""
+    return list(recipe.jss_importer["Arguments"].get("groups", []))
+
+
+def ask_until_valid(submenu, auto):
+    """Ask a submenu's question until a valid choice is made.
+
+    Returns:
+        The submenu's result dict.
+    """
+    while True:
+        try:
+            return submenu.ask(auto=auto)
+        except ChoiceError:
+            print("\n**Invalid entry! Try again.**")
+
+
+def resolve_answers(j, parent_recipe, recipe, parent_filename, env,
+                    package_only, output_format="xml", answers=None,
+                    interactive=True):
+    """Work out the --auto answers without building a Menu.
+
+    Produces the same results as running build_menu()'s Menu with
+    auto=True, but only lists folders or asks the JSS for categories
+    when a question has no default and the user must be prompted.
+
+    Args:
+        j: A python-jss JSS object.
+        parent_recipe: Recipe of the desired parent recipe.
+        recipe: JSSRecipe object to populate.
+        parent_filename: String path to the parent recipe.
+        env: JSSRecipeCreator preferences dict.
+        package_only: boolean, set a package-only recipe
+        output_format: String key of OUTPUT_WRITERS the recipe will be
+            written with; determines the filename extension.
+        answers: Dict of answers already given, keyed as the results.
+            Any "groups" are added to the templated groups.
+        interactive: Bool. If False, questions with no default are
+            answered with "" rather than asked.
+
+    Returns:
+        Dict of results, as Menu.results.
+
+    Raises:
+        AttributeError: If a non-pkg recipe is provided as the parent.
+    """
+    answers = answers or {}
+    default_filename, default_recipe_id, parent_recipe_name = recipe_names(
+        parent_recipe, parent_filename, package_only, output_format)
+    results = recipe_metadata(parent_recipe, parent_recipe_name, env)
+    results.update((key, answers[key]) for key in list(results) if
+                   key in answers)
+    listing = {}
+
+    def cached(key, func):
+        """Only call func once, and only if asked to."""
+        def get():
+            """Return func's (remembered) result."""
+            if key not in listing:
+                listing[key] = func()
+            return listing[key]
+        return get
+
+    def answer(key, default, get_options, optional, heading=""):
+        """Use the default, or prompt as the equivalent Submenu would."""
+        if key in answers:
+            results[key] = answers[key]
+        elif default or not interactive:
+            results[key] = default
+        else:
+            results.update(ask_until_valid(
+                Submenu(key, get_options(), optional, default=default,
+                        heading=heading), auto=True))
+
+    get_templates = cached("templates", list_templates)
+    get_categories = cached("categories",
+                            lambda: [cat.name for cat in j.Category()])
+
+    answer("Recipe Filename", default_filename, lambda: default_filename,
+           False)
+    answer("Identifier", default_recipe_id, lambda: default_recipe_id, False,
+           heading="Recipe Identifier")
+    answer("NAME", parent_recipe_name, lambda: parent_recipe_name, False)
+    if not package_only:
+        answer("POLICY_TEMPLATE",
+               default_policy_template(recipe, env, get_templates),
+               get_templates, True, heading="Policy Template")
+    answer("CATEGORY", recipe["Input"].get("CATEGORY", ""), get_categories,
+           True, heading="Package Category")
+    if not package_only:
+        answer("POLICY_CATEGORY", recipe["Input"].get("POLICY_CATEGORY", ""),
+               get_categories, True, heading="Policy Category")
+        # The scope menu only offers the templated groups in auto mode.
+        results["groups"] = (templated_groups(recipe) +
+                             list(answers.get("groups", [])))
+        icon_default = parent_recipe["Input"].get("NAME", "Icon") + ".png"
+        answer("SELF_SERVICE_ICON", icon_default,
+               lambda: list_icons(icon_default), True,
+               heading="Self Service Icon")
+        default_self_service_desc = recipe["Input"].get(
+            "SELF_SERVICE_DESCRIPTION", "")
+        answer("SELF_SERVICE_DESCRIPTION", default_self_service_desc,
+               lambda: default_self_service_desc, True,
+               heading="Self Service Description")
+
+    return results
+
+
+def create_recipe(parent, answers=None, template=None, package_only=False,
+                  env=None, j=None, output_format="xml"):
+    """Generate a JSS recipe in-process, with no terminal I/O.
+
+    Answers are resolved as with --auto, but questions with no default
+    are answered with "" instead of being asked.
+
+    Args:
+        parent: String path to the parent (pkg) recipe.
+        answers: Dict of answers, keyed as Menu.results (e.g.
+            "CATEGORY", "Identifier"), to use instead of the defaults.
+            "groups" may list group dicts, or just group names; names
+            are looked up on the JSS to see whether they're smart.
+        template: String path to a recipe template, or a JSSRecipe to
+            copy. Defaults to building the recipe from scratch.
+        package_only: boolean, create a package-only recipe.
+        env: JSSRecipeCreator preferences dict. Defaults to no
+            preferences; pass get_preferences() to use the CLI's.
+        j: A python-jss JSS object (or JSSRequestScheduler), only
+            needed to look up groups given by name.
+        output_format: String key of OUTPUT_WRITERS the recipe will be
+            written with; determines the default filename.
+
+    Returns:
+        The JSSRecipe. Its answers attribute holds the resolved answers,
+        including the "Recipe Filename".
+
+    Raises:
+        AttributeError: If a non-pkg recipe is provided as the parent.
+        ChoiceError: A group was given by name without a JSS to look it
+            up on, or a smart group needs a template and none is set.
+        Error: A recipe or template could not be read.
+    """
+    env = env or {}
+    if isinstance(template, JSSRecipe):
+        recipe = template.copy()
+    elif template:
+        recipe = JSSRecipe(template)
+    else:
+        recipe = JSSRecipe()
+        if package_only:
+            recipe.new_plist(package_only=True)
+    parent_recipe = Recipe(parent)
+    add_parent_inputs(recipe, parent_recipe)
+
+    results = resolve_answers(j, parent_recipe, recipe, parent, env,
+                              package_only, output_format, answers,
+                              interactive=False)
+    if not package_only:
+        results["groups"] = [resolve_group(j, group, env) for group in
+                             results["groups"]]
+    recipe.update_recipe(results, package_only, env.get("Recipe_Comment", ""))
+    recipe.answers = results
+    return recipe
+
+
+def create_recipes(parents, answers=None, template=None, package_only=False,
+                   env=None, j=None, output_format="xml"):
+    """Generate JSS recipes in-process, as create_recipe() does.
+
+    The template is read only once, and JSS lookups are cached and
+    rate limited across the whole batch, so this suits long-running
+    services generating many recipes.
+
+    Args:
+        parents: Iterable of parent recipe paths, or of (path, answers)
+            tuples for per-recipe answers.
+        answers: Dict of answers for every recipe. Per-recipe answers
+            take precedence.
+        template, package_only, env, output_format: As create_recipe().
+        j: A python-jss JSS object, which will be wrapped in a
+            JSSRequestScheduler, or a JSSRequestScheduler, to share its
+            cache with other batches.
+
+    Yields:
+        Tuples of (parent path, JSSRecipe), or (parent path, exception)
+        for parents which could not be used.
+    """
+    env = env or {}
+    if j is not None and not isinstance(j, JSSRequestScheduler):
+        j = JSSRequestScheduler.from_preferences(j, env)
+    if template and not isinstance(template, JSSRecipe):
+        template = JSSRecipe(template)
+    for parent in parents:
+        if isinstance(parent, tuple):
+            parent, parent_answers = parent
+        else:
+            parent_answers = {}
+        recipe_answers = dict(answers or {}, **parent_answers)
+        # As in main(), one bad parent shouldn't stop the batch.
+        try:
+            yield parent, create_recipe(parent, recipe_answers, template,
+                                        package_only, env, j, output_format)
+        except Exception as error:  # pylint: disable=broad-except
+            yield parent, error
+
+
+def resolve_group(j, group, env):
+    """Return a group dict for a group dict or name.
+
+    Named groups which exist on the JSS keep their type; new groups
+    are static, as the scope menu's default.
+
+    Raises:
+        ChoiceError: There is no JSS to look a name up on, or a smart
+            group needs a template and Default_Group_Template is unset.
+    """
+    if isinstance(group, Mapping):
+        return group
+    if j is None:
+        raise ChoiceError("A JSS is needed to look up group %s." % group)
+    result = {"name": group, "smart": bool(check_group(j, group))}
+    if result["smart"]:
+        if not env.get("Default_Group_Template"):
+            raise ChoiceError("Smart group %s needs a template." % group)
+        result["template_path"] = env["Default_Group_Template"]
+    return result
+
+
+def check_group(j, name):
+    """Check for whether a group exists, and if so, if it is smart.
+
+    Args:
+        j: A python-jss JSS object.
+        name: The name of the group to check.
+
+    Returns:
+        ScopeSubmenu.SMART_GROUP if group is smart,
+        ScopeSubmenu.STATIC_GROUP if group is static, or None if group
+        doesn't exist.
+
+    Raises:
+        jss.exceptions.GetError: The JSS couldn't say (e.g. still
+            throttled or failing once retries ran out). Guessing would
+            turn an existing smart group into a static one.
+    """
+    try:
+        group = j.ComputerGroup(name)
+    except jss.exceptions.GetError as error:
+        if get_status_code(error) != 404:
+            raise
+        group = None
+
+    if group is None:
+        result = None
+    elif group.findtext("is_smart") == "true":
+        result = ScopeSubmenu.SMART_GROUP
+    else:
+        result = ScopeSubmenu.STATIC_GROUP
+
+    return result
+
+
+def build_argparser(env):
+    """Create JSSRecipeCreator argument parser.
+
+    Args:
+        env: Dict of JSSRecipeCreator preferences.
+
+    Returns:
+        Configured ArgumentParser.
+    """
+    parser = argparse.ArgumentParser(description="Quickly generate JSS "
+                                     "recipes.")
     parser.add_argument("ParentRecipe", help="Path to a parent recipe.",
                         nargs="*")
 
@@ -835,10 +2303,587 @@ def build_argparser(env):
         "-d", "--dest", help="Path (folder) to which to write the recipe. "
         "Defaults to %s." % default_destination_folder,
         default=default_destination_folder)
+    parser.add_argument(
+        "-f", "--format", help="File format for the recipe: XML plist, "
+        "binary plist, or YAML. Defaults to %s." %
+        env.get("Default_Output_Format", "xml"), dest="output_format",
+        choices=sorted(OUTPUT_WRITERS),
+        default=env.get("Default_Output_Format", "xml"))
+    parser.add_argument(
+        "--prefetch", help="Prepare the next parent recipe in the "
+        "background while questions about the current one are being "
+        "answered.", action="store_true")
+    parser.add_argument(
+        "--shard", help="Only generate the parent recipes belonging to "
+        "shard i of N (e.g. 2/4), as decided by a hash of their "
+        "identifiers. Writes a manifest of the results for --merge.",
+        type=parse_shard)
+    parser.add_argument(
+        "--manifest", help="Path to which to write the manifest of "
+        "generated recipes. Defaults to %s/shard-i-of-N.plist in the "
+        "destination folder when --shard is used." % STATE_FOLDER)
+    parser.add_argument(
+        "--merge", help="Combine shard manifests into one report (written "
+        "to --manifest if given), checking for collisions between shards, "
+        "and exit.", nargs="+", metavar="MANIFEST")
+    parser.add_argument(
+        "--answers", help="Where to keep the answers learned from earlier "
+        "runs, which fill in questions the template leaves blank. Defaults "
+        "to .jss_recipe_creator/answers.plist in the destination folder.")
+    parser.add_argument(
+        "--no_learning", help="Neither use nor record learned answers.",
+        action="store_true")
+    parser.add_argument(
+        "--migrate", help="Update the recipes in the destination folder, "
+        "which were made from OLD_TEMPLATE, to the structure of the recipe "
+        "template, keeping their values. Shows the changes, asks before "
+        "writing them (unless --auto), and exits.", metavar="OLD_TEMPLATE")
+    parser.add_argument(
+        "--resume", help="Skip the parent recipes which the journal shows "
+        "were completed by a previous run with the same inputs.",
+        action="store_true")
+    parser.add_argument(
+        "--journal", help="Path to the journal of completed parent recipes. "
+        "Defaults to %s/journal.jsonl (journal-i-of-N.jsonl when sharding) "
+        "in the destination folder." % STATE_FOLDER)
+    parser.add_argument(
+        "--dry_run", help="Report which recipes would be created or changed, "
+        "without writing anything.", action="store_true")
+    parser.add_argument(
+        "--batch_size", help="Number of recipes to write at once, all or "
+        "nothing. Larger batches write faster to network volumes, but up to "
+        "a batch of work may be lost if the run dies. Defaults to 1.",
+        type=int, default=1)
+    parser.add_argument(
+        "--git_commit", help="Commit the recipes written or changed, and "
+        "their icons, to the git repository holding the destination folder, "
+        "in a single commit.", action="store_true")
+    parser.add_argument(
+        "--provision", help="After generating recipes, create any of the "
+        "categories and groups they refer to which are missing from the "
+        "JSS.", action="store_true")
+    parser.add_argument(
+        "--on_collision", help="What to do when a recipe's identifier or "
+        "filename is already in use, in the destination folder, the AutoPkg "
+        "recipe search dirs, or earlier in this run: 'fail' skips the "
+        "recipe, 'suffix' appends a number. Defaults to 'fail'.",
+        choices=("fail", "suffix"), default="fail")
 
     return parser
 
 
+def split_recipe_extension(filename):
+    """Split a recipe filename into its name and recipe extension.
+
+    The extension includes any JSS recipe type, e.g. "Foo.bar" and
+    ".jss.recipe" for "Foo.bar.jss.recipe".
+    """
+    for extension in RECIPE_EXTENSIONS:
+        if filename.endswith(extension):
+            stem = filename[:-len(extension)]
+            break
+    else:
+        stem, extension = os.path.splitext(filename)
+    for recipe_type in (".jss-upload", ".jss"):
+        if stem.endswith(recipe_type):
+            return stem[:-len(recipe_type)], recipe_type + extension
+    return stem, extension
+
+
+def recipe_filename(filename, output_format):
+    """Return filename with the recipe extension for output_format.
+
+    Args:
+        filename: String recipe filename, with any recipe extension.
+        output_format: String key of OUTPUT_WRITERS.
+    """
+    for extension in RECIPE_EXTENSIONS:
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+            break
+    return filename + OUTPUT_WRITERS[output_format].extension
+
+
+def load_recipes(parent, args):
+    """Load the recipe template and parent recipe for one recipe.
+
+    Args:
+        parent: String path to the parent recipe.
+        args: Arguments returned from argparser.
+
+    Returns:
+        Tuple of (JSSRecipe to populate, parent Recipe).
+    """
+    # Create a JSSRecipe object
+    # from_scratch and recipe_template are mutually exclusive
+    if args.from_scratch:
+        recipe = JSSRecipe()
+    else:
+        recipe = JSSRecipe(args.recipe_template)
+
+    # We need a parent recipe to use for determining some values.
+    parent_recipe = Recipe(parent)
+    add_parent_inputs(recipe, parent_recipe)
+
+    return recipe, parent_recipe
+
+
+def add_parent_inputs(recipe, parent_recipe):
+    """Add any input variables the parent recipe needs to recipe."""
+    # If the parent recipe uses PlistReader to determine version, we
+    # need to add a blank version input var to the jss recipe to get
+    # past the AutoPkg preprocessor.
+    # Recipes may use multiple versioning processors. If either
+    # Versioner or AppDmgVersioner are present, we probably don't need a
+    # <version> tag.
+    # Custom processors may also output version.
+    # Without parsing each processor, this is the best we can do.
+    # Thankfully, overriding <version> with a blank value won't unset
+    # versions found earlier, so this is a safe assumption to make.
+    parent_processors = [processor["Processor"] for processor in
+                         parent_recipe["Process"]]
+    if "PlistReader" in parent_processors:
+        if "Versioner" not in parent_processors or ("AppDmgVersioner" not
+                                                    in parent_processors):
+            recipe.add_input_var("version")
+
+
+def prefetch(func, items, background=True):
+    """Pair each item with a task preparing func(item).
+
+    While the caller is busy with one item, func is already running on
+    the next one in a background thread, so that it is (hopefully)
+    ready by the time it is needed. func must not prompt the user.
+
+    Args:
+        func: Callable taking a single item.
+        items: Iterable of items to prepare.
+        background: Bool. If False, each item is prepared only when
+            its result is asked for.
+
+    Yields:
+        Tuples of (item, BackgroundTask for func(item)).
+    """
+    items = list(items)
+    tasks = [None] * len(items)
+    for index, item in enumerate(items):
+        if tasks[index] is None:
+            tasks[index] = BackgroundTask(func, item, start=False)
+        if background and index + 1 < len(items):
+            tasks[index + 1] = BackgroundTask(func, items[index + 1])
+        yield item, tasks[index]
+        tasks[index] = None
+
+
+def parse_shard(value):
+    """Parse an "i/N" shard specification for argparse.
+
+    Returns:
+        Tuple of ints (i, N), with i counted from 1.
+    """
+    try:
+        shard, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Shards must be given as i/N, e.g. 1/4.")
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError(
+            "Shard %s must be between 1 and %s." % (shard, count))
+    return shard, count
+
+
+def shard_of(key, count):
+    """Return the shard (from 1) to which key belongs.
+
+    Uses a stable hash, so a key stays in the same shard no matter
+    which other keys are present.
+    """
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return int(digest, 16) % count + 1
+
+
+def identifier_prefix(identifier):
+    """Return the vendor part of a recipe identifier.
+
+    e.g. "com.github.foo." for "com.github.foo.pkg.Firefox".
+    """
+    segments = identifier.split(".")[:-1]
+    if segments and segments[-1] in ("download", "pkg", "jss",
+                                     "jss-upload", "install", "munki"):
+        segments.pop()
+    return ".".join(segments) + "."
+
+
+def parent_identifier(parent):
+    """Return a parent recipe's identifier, or None if unreadable."""
+    try:
+        return Plist(parent).get("Identifier")
+    except Error:
+        return None
+
+
+def merge_manifests(paths, output=None):
+    """Combine shard manifests and report on the whole batch.
+
+    Args:
+        paths: List of string paths to shard manifests.
+        output: Optional string path to write the combined manifest.
+
+    Returns:
+        List of string problems found: identifier or filename
+        collisions between recipes, and missing shards.
+    """
+    merged = Manifest()
+    shards = set()
+    counts = set()
+    print_heading("Shards")
+    for path in paths:
+        manifest = Manifest(path)
+        shards.add(manifest["Shard"])
+        counts.add(manifest["Shards"])
+        merged["Recipes"].extend(manifest["Recipes"])
+        merged["Skipped"].extend(manifest["Skipped"])
+        print("%s: shard %s/%s, %d recipes, %d skipped" % (
+            path, manifest["Shard"], manifest["Shards"],
+            len(manifest["Recipes"]), len(manifest["Skipped"])))
+
+    problems = []
+    if len(counts) > 1:
+        problems.append("Manifests disagree on the number of shards: %s" %
+                        ", ".join(str(count) for count in sorted(counts)))
+    elif counts:
+        missing = set(range(1, counts.pop() + 1)) - shards
+        problems.extend("Shard %d is missing." % shard for shard in
+                        sorted(missing))
+
+    by_identifier = {}
+    by_filename = {}
+    for entry in merged["Recipes"]:
+        by_identifier.setdefault(entry["Identifier"], []).append(entry)
+        by_filename.setdefault(normalize_path(entry["Filename"]),
+                               []).append(entry)
+    for identifier, entries in sorted(by_identifier.items()):
+        if len(entries) > 1:
+            problems.append("Identifier %s is used by %s." % (
+                identifier, ", ".join(entry["Filename"] for entry in
+                                      entries)))
+    for entries in by_filename.values():
+        if len(entries) > 1:
+            problems.append("%s is written by %s." % (
+                entries[0]["Filename"], ", ".join(
+                    entry["ParentRecipe"] for entry in entries)))
+
+    print_heading("Report")
+    print("%d recipes, %d skipped, %d problems." % (
+        len(merged["Recipes"]), len(merged["Skipped"]), len(problems)))
+    for entry in merged["Skipped"]:
+        print("Skipped %s: %s" % (entry["ParentRecipe"], entry["Reason"]))
+    for problem in problems:
+        print(problem)
+
+    if output:
+        merged["Shards"] = len(shards)
+        merged["Problems"] = problems
+        merged.write_plist(output)
+    return problems
+
+
+def migrate_recipes(old_template, new_template, folder, dry_run=False,
+                    auto=False, workers=WRITER_THREADS):
+    """Migrate JSS recipes from one version of a template to another.
+
+    Prints the changes between the templates and a diff of every recipe
+    they change, then (after asking, unless auto) writes all of the
+    changed recipes as one atomic batch, each in its own format.
+
+    Only recipes with all of the processors and processor arguments of
+    one of the templates are migrated; others (e.g. package-only
+    recipes, when migrating the full template) are listed as skipped.
+    Migrated recipes are rewritten in full, so the diffs are against
+    the files as they are on disk, showing any reformatting or lost
+    comments.
+
+    Args:
+        old_template: String path to the template the recipes in folder
+            were made from.
+        new_template: String path to the template to migrate them to.
+        folder: String path to search for recipes.
+        dry_run: Bool. If True, only show what would change.
+        auto: Bool. If True, don't ask before writing.
+        workers: Int number of threads to migrate and write with.
+
+    Returns:
+        List of string problems found; empty if all went well.
+    """
+    try:
+        templates = (Recipe(old_template), Recipe(new_template))
+    except Error as error:
+        return [str(error)]
+    delta = TemplateDelta(*templates)
+    print_heading("Template Changes")
+    if not delta:
+        print("The templates have the same structure; nothing to do.")
+        return []
+    print(delta)
+
+    skipped = []
+
+    def migrate(path):
+        """Return (path, new content, diff), or None if unchanged."""
+        try:
+            recipe = JSSRecipe(path)
+        except PlistDataError:
+            # Not a JSS recipe; it wasn't made from the template.
+            return None
+        if not any(fits_template(recipe, template) for template in
+                   templates):
+            skipped.append(path)
+            return None
+        migrated = delta.apply(recipe)
+        if migrated == to_native(recipe):
+            return None
+        output_format = recipe_format(path)
+        content = OUTPUT_WRITERS[output_format].serialize(migrated)
+        if output_format == "plist":
+            # Binary plists have no formatting to lose; diff them as XML.
+            before, after = [
+                XMLPlistWriter.serialize(data) for data in (recipe,
+                                                            migrated)]
+        else:
+            with open(path, "rb") as handle:
+                before = handle.read()
+            after = content
+        before, after = [text.decode("utf-8").splitlines(True) for text in
+                         (before, after)]
+        return path, content, "".join(difflib.unified_diff(
+            before, after, path, path))
+
+    problems = []
+    changed = []
+    for result in parallel_map(migrate, sorted(find_recipes([folder])),
+                               workers):
+        if isinstance(result, Exception):
+            problems.append(str(result))
+        elif result:
+            changed.append(result)
+
+    print_heading("Recipe Changes")
+    for _, _, diff in changed:
+        print(diff)
+    for problem in problems:
+        print(problem)
+    for path in sorted(skipped):
+        print("Skipping %s: it doesn't have the template's processors and "
+              "arguments." % path)
+    print("%d recipe(s) to migrate." % len(changed))
+    if not changed or dry_run:
+        return problems
+    if not auto and input("Apply these changes? (Y|N) ").upper() != "Y":
+        return problems
+
+    writer = BatchWriter(workers)
+    for path, content, _ in changed:
+        writer.add(path, content)
+    try:
+        writer.commit()
+    except Error as error:
+        problems.append(str(error))
+    return problems
+
+
+def fits_template(recipe, template):
+    """Return whether recipe has all of template's processors and args.
+
+    Recipes may have more processors and arguments than the template
+    they were made from (e.g. hand edits), but not fewer.
+    """
+    arguments = dict((processor.get("Processor"),
+                      processor.get("Arguments", {})) for processor in
+                     recipe.get("Process", []))
+    for processor in template.get("Process", []):
+        name = processor.get("Processor")
+        if name not in arguments or any(
+                key not in arguments[name] for key in
+                processor.get("Arguments", {})):
+            return False
+    return True
+
+
+def find_recipes(folders):
+    """Yield the path of every recipe beneath folders.
+
+    Hidden folders (like our own state folder) are skipped.
+
+    Args:
+        folders: Iterable of string folder paths.
+    """
+    seen = set()
+    for folder in folders:
+        folder = os.path.expanduser(folder)
+        if folder in seen or not os.path.isdir(folder):
+            continue
+        seen.add(folder)
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [name for name in dirnames if
+                           not name.startswith(".")]
+            for filename in filenames:
+                if filename.endswith(RECIPE_EXTENSIONS):
+                    yield os.path.join(dirpath, filename)
+
+
+def recipe_format(path):
+    """Return the OUTPUT_WRITERS key for the format of the file at path."""
+    if path.endswith(".yaml"):
+        return "yaml"
+    with open(os.path.expanduser(path), "rb") as handle:
+        if handle.read(6) == b"bplist":
+            return "plist"
+    return "xml"
+
+
+def substitute(value, variables):
+    """Replace %KEY% substitution variables, as AutoPkg would.
+
+    Variables whose values contain more variables are expanded too.
+    Unknown variables are left in place.
+
+    Args:
+        value: String to expand.
+        variables: Dict of substitution variable values.
+    """
+    def lookup(match):
+        """Return a variable's value, or the original text."""
+        return u"%s" % variables.get(match.group(1), match.group(0))
+
+    # Guard against variables which refer to themselves.
+    for _ in range(10):
+        expanded = re.sub(r"%(\w+)%", lookup, value)
+        if expanded == value:
+            break
+        value = expanded
+    return value
+
+
+def collect_jss_objects(recipe_paths, template_folders):
+    """Gather the categories and groups a batch of recipes refers to.
+
+    Args:
+        recipe_paths: Iterable of string paths to JSS recipes.
+        template_folders: List of string folders in which to look for
+            smart group templates, after each recipe's own folder.
+
+    Returns:
+        Tuple of (set of category names, dict of group name to a group
+        dict with "smart", "template_path" (resolved path or None) and
+        "variables" items).
+    """
+    categories = set()
+    groups = {}
+    for path in recipe_paths:
+        recipe = JSSRecipe(path)
+        variables = dict(recipe["Input"])
+        variables.setdefault("PROD_NAME", variables.get("NAME", ""))
+        variables.setdefault("JSS_INVENTORY_NAME",
+                             "%s.app" % variables.get("NAME", ""))
+        arguments = recipe.jss_importer["Arguments"]
+        for key in ("category", "policy_category"):
+            category = substitute(arguments.get(key, ""), variables)
+            if category and "%" not in category:
+                categories.add(category)
+
+        for group in arguments.get("groups", []):
+            name = substitute(group["name"], variables)
+            if not name or "%" in name or name in groups:
+                continue
+            template_path = None
+            if group.get("smart") and group.get("template_path"):
+                filename = substitute(group["template_path"], variables)
+                folders = [os.path.dirname(os.path.abspath(path))]
+                for folder in folders + template_folders:
+                    candidate = os.path.join(os.path.expanduser(folder),
+                                             filename)
+                    if os.path.isfile(candidate):
+                        template_path = candidate
+                        break
+            groups[name] = {"smart": bool(group.get("smart")),
+                            "template_path": template_path,
+                            "variables": dict(variables, group_name=name)}
+    return categories, groups
+
+
+def provision(j, recipe_paths, template_folders=(os.curdir,)):
+    """Create the categories and groups missing from the JSS.
+
+    Everything the recipes refer to is compared with the JSS's
+    listings, and whatever is missing is created in one pass through
+    the request scheduler. Smart groups are created from their
+    templates; any %VERSION% style variables which are only known at
+    AutoPkg run time are left for JSSImporter to fill in, as it updates
+    the group on every run anyway.
+
+    Args:
+        j: A JSSRequestScheduler.
+        recipe_paths: Iterable of string paths to JSS recipes.
+        template_folders: List of string folders in which to look for
+            smart group templates, after each recipe's own folder.
+
+    Returns:
+        List of string problems; objects which could not be created.
+    """
+    categories, groups = collect_jss_objects(recipe_paths,
+                                             list(template_folders))
+    missing_categories = sorted(categories -
+                                set(cat.name for cat in j.Category()))
+    existing_groups = set(group.name for group in j.ComputerGroup())
+    missing_groups = sorted(name for name in groups if
+                            name not in existing_groups)
+
+    print_heading("Provisioning")
+    print("%d categories and %d groups referenced; creating %d and %d." % (
+        len(categories), len(groups), len(missing_categories),
+        len(missing_groups)))
+
+    problems = []
+    to_create = []
+    for name in missing_categories:
+        to_create.append(("Category", name, jss.Category(j.j, name)))
+    for name in missing_groups:
+        group = groups[name]
+        if not group["smart"]:
+            obj = jss.ComputerGroup(j.j, name)
+        elif group["template_path"]:
+            with open(group["template_path"]) as handle:
+                xml = substitute(handle.read(), group["variables"])
+            try:
+                obj = jss.ComputerGroup.from_string(j.j, xml)
+            except ElementTree.ParseError as error:
+                problems.append("Smart group template %s for %s is invalid: "
+                                "%s" % (group["template_path"], name, error))
+                continue
+        else:
+            problems.append("No smart group template found for %s." % name)
+            continue
+        to_create.append(("Computer group", name, obj))
+
+    for kind, name, obj in to_create:
+        # POST directly, rather than with obj.save(), so that a retry
+        # can never turn into a PUT, and there is no read-back.
+        try:
+            j.perform(j.j.post, obj.url, data=obj)
+            print("Created %s %s" % (kind.lower(), name))
+        except Exception as error:  # pylint: disable=broad-except
+            # A conflict means someone else got there first.
+            if get_status_code(error) != 409:
+                problems.append("Could not create %s %s: %s" % (
+                    kind.lower(), name, error))
+
+    j.invalidate("Category")
+    j.invalidate("ComputerGroup")
+    for problem in problems:
+        print(problem)
+    return problems
+
+
 def to_bool(val):
     """Convert string bool values to python Bool."""
     if val == "false":
@@ -849,6 +2894,296 @@ def to_bool(val):
         raise ValueError()
 
 
+def get_status_code(error):
+    """Return the HTTP status code of a python-jss error, or None."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        match = re.search(r"Response Code: (\d+)", str(error))
+        if match:
+            status = int(match.group(1))
+    return status
+
+
+def parallel_map(func, items, workers):
+    """Return [func(item) for item in items], using worker threads.
+
+    func should handle its own errors; anything it raises is returned
+    in place of its result.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    work = queue.Queue()
+    for index, item in enumerate(items):
+        work.put((index, item))
+
+    def worker():
+        """Work through the queue."""
+        while True:
+            try:
+                index, item = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as error:  # pylint: disable=broad-except
+                results[index] = error
+
+    threads = [threading.Thread(target=worker) for _ in
+               range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def fsync_folder(folder):
+    """Sync a folder, so that renames within it are durable."""
+    try:
+        handle = os.open(folder or os.curdir, os.O_RDONLY)
+    except EnvironmentError:
+        return
+    try:
+        os.fsync(handle)
+    except EnvironmentError:
+        # Not every filesystem allows syncing folders.
+        pass
+    finally:
+        os.close(handle)
+
+
+def lint_recipes(paths, output_format):
+    """Check the syntax of written recipes.
+
+    Args:
+        paths: List of string paths to recipes.
+        output_format: String key of OUTPUT_WRITERS they were written
+            with.
+    """
+    if not paths:
+        return
+    print_heading("Lint")
+    if output_format == "yaml":
+        print("Checking YAML syntax...")
+        for path in paths:
+            try:
+                Plist(path)
+                print("%s: OK" % path)
+            except Error as error:
+                print(error)
+    else:
+        print("Checking plist syntax...")
+        try:
+            subprocess.check_call(["plutil", "-lint"] + paths)
+        except subprocess.CalledProcessError:
+            print("Could not find file!")
+
+
+def commit_message(written):
+    """Summarize written recipes for a git commit message.
+
+    Args:
+        written: List of (path, BatchWriter status, identifier) tuples.
+    """
+    added = [item for item in written if item[1] == BatchWriter.NEW]
+    updated = [item for item in written if item[1] != BatchWriter.NEW]
+    counts = []
+    if added:
+        counts.append("add %d" % len(added))
+    if updated:
+        counts.append("update %d" % len(updated))
+    summary = " and ".join(counts)
+    lines = ["%s%s JSS recipe%s" % (summary[0].upper(), summary[1:],
+                                    "" if len(written) == 1 else "s")]
+    for heading, items in (("Added", added), ("Updated", updated)):
+        if items:
+            lines.extend(["", "%s:" % heading])
+            lines.extend("    %s (%s)" % (os.path.basename(path), identifier)
+                         for path, _, identifier in items)
+    return "\n".join(lines) + "\n"
+
+
+def git_commit(paths, message, fast_import_threshold=GIT_FAST_IMPORT_THRESHOLD):
+    """Commit files to the git repository holding them, in one commit.
+
+    The files are staged with a single git add, and committed without
+    touching anything else already staged. Batches of at least
+    fast_import_threshold files are instead written straight to the
+    current branch with git fast-import, and only their index entries
+    are then refreshed.
+
+    With git older than 2.25, the paths are passed on the command line
+    rather than through stdin: staged GIT_PATHSPEC_CHUNK at a time, and
+    committed all at once, so very large batches committed through the
+    index may exceed the system's argument limit.
+
+    Args:
+        paths: List of string paths to the files to commit, all in one
+            repository.
+        message: String commit message.
+        fast_import_threshold: Int number of files from which to use
+            git fast-import.
+
+    Returns:
+        String hash of the new commit.
+
+    Raises:
+        GitError: A git command failed (e.g. not a git repository, or
+            nothing to commit).
+    """
+    folder = os.path.dirname(os.path.realpath(paths[0]))
+    top = run_git(["rev-parse", "--show-toplevel"], folder).strip()
+    relative = [os.path.relpath(os.path.realpath(path), top) for path in
+                paths]
+    from_file = git_version(top) >= GIT_PATHSPEC_FROM_FILE_VERSION
+
+    branch = None
+    if len(paths) >= fast_import_threshold:
+        try:
+            branch = run_git(["symbolic-ref", "-q", "HEAD"], top).strip()
+        except GitError:
+            # Detached HEAD; commit normally.
+            pass
+    if branch:
+        fast_import(top, branch, relative, message)
+        run_git_on_paths(["reset", "-q"], top, relative, from_file)
+    else:
+        run_git_on_paths(["add"], top, relative, from_file)
+        handle, message_path = tempfile.mkstemp()
+        try:
+            os.write(handle, message.encode("utf-8"))
+            os.close(handle)
+            run_git_on_paths(["commit", "-q", "-F", message_path], top,
+                             relative, from_file, chunk=len(relative))
+        finally:
+            os.remove(message_path)
+    return run_git(["rev-parse", "HEAD"], top).strip()
+
+
+def fast_import(top, branch, paths, message):
+    """Commit files onto branch with git fast-import.
+
+    Args:
+        top: String path to the top of the repository.
+        branch: String ref to commit to, e.g. "refs/heads/master".
+        paths: List of string paths, relative to top.
+        message: String commit message.
+    """
+    def data(content):
+        """Return a fast-import data command for content."""
+        return ("data %d\n" % len(content)).encode("ascii") + content + b"\n"
+
+    def quote(path):
+        """Quote a path for fast-import."""
+        return '"%s"' % path.replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")
+
+    committer = run_git(["var", "GIT_COMMITTER_IDENT"], top).strip()
+    stream = [("commit %s\ncommitter %s\n" % (branch, committer)).encode(
+        "utf-8"), data(message.encode("utf-8"))]
+    try:
+        parent = run_git(["rev-parse", "--verify", "-q", branch], top).strip()
+        stream.append(("from %s\n" % parent).encode("ascii"))
+    except GitError:
+        # The branch has no commits yet.
+        pass
+    for path in paths:
+        with open(os.path.join(top, path), "rb") as handle:
+            content = handle.read()
+        stream.append(("M 100644 inline %s\n" % quote(path)).encode("utf-8"))
+        stream.append(data(content))
+    run_git(["fast-import", "--quiet"], top, b"".join(stream))
+
+
+def run_git(arguments, folder, stdin=None):
+    """Run a git command in folder and return its output.
+
+    Args:
+        arguments: List of string arguments to git.
+        folder: String path to run git in.
+        stdin: Optional bytes to send to git.
+
+    Raises:
+        GitError: git could not be run, or failed.
+    """
+    try:
+        process = subprocess.Popen(["git"] + arguments, cwd=folder,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except EnvironmentError as error:
+        raise GitError("Could not run git: %s" % error)
+    output, errors = process.communicate(stdin)
+    if process.returncode:
+        raise GitError("git %s failed: %s" % (
+            arguments[0], (errors or output).decode("utf-8", "replace").strip()))
+    return output.decode("utf-8")
+
+
+def run_git_on_paths(arguments, folder, paths, from_file, chunk=None):
+    """Run a git command on a list of paths.
+
+    Args:
+        arguments: List of string arguments to git, before the paths.
+        folder: String path to run git in.
+        paths: List of string paths, relative to folder.
+        from_file: Bool; whether git supports --pathspec-from-file. If
+            so, the paths go through stdin, so there's no limit on
+            their number; otherwise the command is run once for each
+            chunk of paths.
+        chunk: Int number of paths to pass to each command. Defaults
+            to GIT_PATHSPEC_CHUNK.
+
+    Raises:
+        GitError: git could not be run, or failed.
+    """
+    if from_file:
+        run_git(arguments + ["--pathspec-from-file=-",
+                             "--pathspec-file-nul"], folder,
+                b"\0".join(path.encode("utf-8") for path in paths))
+        return
+    chunk = chunk or GIT_PATHSPEC_CHUNK
+    for start in range(0, len(paths), chunk):
+        run_git(arguments + ["--"] + paths[start:start + chunk], folder)
+
+
+def git_version(folder):
+    """Return git's version as a tuple of ints, e.g. (2, 25, 1).
+
+    Raises:
+        GitError: git could not be run, or failed.
+    """
+    output = run_git(["--version"], folder)
+    match = re.search(r"(\d+(?:\.\d+)+)", output)
+    if not match:
+        raise GitError("Unrecognized git version: %s" % output.strip())
+    return tuple(int(part) for part in match.group(1).split("."))
+
+
+def json_hash(value):
+    """Return a SHA-1 hex digest of a JSON-serializable value."""
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode(
+        "utf-8")).hexdigest()
+
+
+def file_hash(path):
+    """Return the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(os.path.expanduser(path), "rb") as handle:
+        for chunk in iter(lambda: handle.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_path(path):
+    """Normalize a path for comparison.
+
+    Lower-cased since the default macOS filesystems are case
+    insensitive.
+    """
+    return os.path.abspath(os.path.expanduser(path)).lower()
+
+
 def in_range(val, size):
     """Determine whether a value x is within the range 0 > x <= size."""
     return val < size and val >= 0
@@ -916,66 +3251,284 @@ def main():
         sys.exit("Preferences cleared. Please run script again without "
                  "-c/--clear-prefs option")
 
-    # Get AutoPkg configuration settings for python-jss/JSSImporter.
-    autopkg_env = Plist(AUTOPKG_PREFERENCES)
-    j = configure_jss(autopkg_env)
+    # Paths derived from the destination are used as keys (written
+    # files, journal entries), so settle on one spelling up front.
+    args.dest = os.path.expanduser(args.dest)
+
+    if args.merge:
+        if merge_manifests(args.merge, args.manifest):
+            sys.exit(1)
+        sys.exit()
 
     # alter default parent recipe for package-only mode
     if args.package_only and args.recipe_template == env["Default_Recipe_Template"]:
         args.recipe_template = env["Package_Only_Recipe_Template"]
 
-    for parent in args.ParentRecipe:
-        print(parent)
-        # Create a JSSRecipe object
-        # from_scratch and recipe_template are mutually exclusive
+    if args.migrate:
         if args.from_scratch:
-            recipe = JSSRecipe()
-        else:
-            recipe = JSSRecipe(args.recipe_template)
-
-        # We need a parent recipe to use for determining some values.
-        parent_recipe = Recipe(parent)
-        # If the parent recipe uses PlistReader to determine version, we
-        # need to add a blank version input var to the jss recipe to get
-        # past the AutoPkg preprocessor.
-        # Recipes may use multiple versioning processors. If either
-        # Versioner or AppDmgVersioner are present, we probably don't need a
-        # <version> tag.
-        # Custom processors may also output version.
-        # Without parsing each processor, this is the best we can do.
-        # Thankfully, overriding <version> with a blank value won't unset
-        # versions found earlier, so this is a safe assumption to make.
-        parent_processors = [processor["Processor"] for processor in
-                             parent_recipe["Process"]]
-        if "PlistReader" in parent_processors:
-            if "Versioner" not in parent_processors or ("AppDmgVersioner" not
-                                                        in parent_processors):
-                recipe.add_input_var("version")
-
-        # Build our interactive menu
-        menu = build_menu(j, parent_recipe, recipe, parent, env, args.package_only)
+            parser.error("--migrate needs a recipe template to migrate to.")
+        if migrate_recipes(args.migrate, args.recipe_template, args.dest,
+                           args.dry_run, args.auto,
+                           int(env.get("Writer_Threads", WRITER_THREADS))):
+            sys.exit(1)
+        sys.exit()
 
-        # Run the questions past the user.
-        menu.run(auto=args.auto, package_only=args.package_only)
-
-        print_heading("Results")
-        pprint(menu.results)
+    # Get AutoPkg configuration settings for python-jss/JSSImporter.
+    try:
+        autopkg_env = Plist(AUTOPKG_PREFERENCES)
+    except PlistParseError as error:
+        sys.exit(error)
+    j = JSSRequestScheduler.from_preferences(configure_jss(autopkg_env), env)
+
+    # Index existing recipes so that we don't clobber any of them.
+    recipe_index = RecipeIndex()
+    recipe_index.seed([args.dest] +
+                      list(autopkg_env.get("RECIPE_SEARCH_DIRS", [])))
+
+    # Only keep this shard's parents. Unreadable parents are sharded by
+    # path so that they still fail in exactly one shard.
+    parents = args.ParentRecipe
+    manifest = Manifest()
+    if args.shard:
+        manifest["Shard"], manifest["Shards"] = args.shard
+        parents = [parent for parent in parents if shard_of(
+            parent_identifier(parent) or parent,
+            manifest["Shards"]) == manifest["Shard"]]
+        if not args.manifest:
+            args.manifest = os.path.join(
+                args.dest, STATE_FOLDER, "shard-%d-of-%d.plist" % args.shard)
+
+    answer_store = None
+    if not args.no_learning:
+        try:
+            answer_store = AnswerStore(args.answers or os.path.join(
+                args.dest, STATE_FOLDER, "answers." + STATE_FORMAT))
+        except PlistParseError as error:
+            print("Not using learned answers: %s" % error)
 
-        # Merge the answers with the JSSRecipe.
-        recipe.update_recipe(menu.results, args.package_only, env.get("Recipe_Comment", ""))
-        dest_path = os.path.join(args.dest, menu.results["Recipe Filename"])
-        print(("\nWriting to %s" % dest_path))
-        recipe.write_plist(dest_path)
+    def learned_answers(parent):
+        """Return what learned answers would change in parent's recipe.
 
-        # Final output.
-        print_heading("Lint")
-        print("Checking plist syntax...")
+        Returns:
+            The recipe template as prepare() will fill it in, or {} if
+            the learned answers change nothing.
+        """
+        if answer_store is None:
+            return {}
+        recipe, parent_recipe = load_recipes(parent, args)
+        before = to_native(recipe)
+        answer_store.apply(recipe, parent_recipe, recipe_names(
+            parent_recipe, parent, args.package_only)[2])
+        after = to_native(recipe)
+        return after if after != before else {}
+
+    # Skip whatever a previous run already finished. A parent whose
+    # preferences, or the learned answers filled into its template,
+    # have changed since is redone.
+    template = None if args.from_scratch else args.recipe_template
+    options = {"package_only": args.package_only,
+               "output_format": args.output_format,
+               "dest": os.path.abspath(args.dest),
+               "preferences": to_native(env)}
+    if not args.journal:
+        args.journal = os.path.join(args.dest, STATE_FOLDER, (
+            "journal-%d-of-%d.jsonl" % args.shard if args.shard else
+            "journal.jsonl"))
+    journal = Journal(args.journal, resume=args.resume,
+                      read_only=args.dry_run)
+    hashes = {}
+    for parent in parents:
         try:
-            subprocess.check_call(["plutil", "-lint", dest_path])
-        except subprocess.CalledProcessError:
-            print("Could not find file!")
-        print("\nDon't forget to copy the icon to the recipe's directory,"
-              "and commit your changes to git!\n")
+            hashes[parent] = Journal.input_hashes(parent, template, options,
+                                                  learned_answers(parent))
+        except (EnvironmentError, Error, AttributeError):
+            # Let it fail properly, with the other per-recipe errors.
+            hashes[parent] = None
+        entry = journal.completed(parent, hashes[parent])
+        if entry:
+            print("%s was completed by a previous run." % parent)
+            manifest.add_recipe(parent, entry["ParentIdentifier"],
+                                entry["Identifier"], entry["Filename"])
+    parents = [parent for parent in parents if
+               not journal.completed(parent, hashes[parent])]
+
+    def prepare(parent):
+        """Load everything needed to start asking about parent."""
+        recipe, parent_recipe = load_recipes(parent, args)
+        if answer_store is not None:
+            answer_store.apply(recipe, parent_recipe, recipe_names(
+                parent_recipe, parent, args.package_only)[2])
+        if args.auto:
+            # Answers are resolved directly; no menu needed.
+            menu = None
+        else:
+            menu = build_menu(j, parent_recipe, recipe, parent, env,
+                              args.package_only, args.output_format)
+        return recipe, parent_recipe, menu
+
+    writer = BatchWriter(int(env.get("Writer_Threads", WRITER_THREADS)),
+                         dry_run=args.dry_run)
+    queued = []
+    written = []
+    failures = []
+
+    def flush():
+        """Write the queued recipes, then record and lint them."""
+        batch = list(queued)
+        del queued[:]
+        if not batch:
+            return
+        try:
+            statuses = writer.commit()
+        except Error as error:
+            print("\nFailed to write recipes: %s" % error)
+            for parent, _, _ in batch:
+                manifest.add_skipped(parent, error)
+                failures.append(parent)
+            return
+        for parent, dest_path, results in batch:
+            if statuses[dest_path] != BatchWriter.UNCHANGED:
+                written.append((dest_path, statuses[dest_path], results))
+            manifest.add_recipe(parent, results["ParentRecipe"],
+                                results["Identifier"],
+                                os.path.relpath(dest_path, args.dest))
+            journal.record(parent, hashes[parent], Output=dest_path,
+                           **manifest["Recipes"][-1])
+            if answer_store is not None:
+                answer_store.record(results)
+        if not args.dry_run:
+            lint_recipes([path for path in statuses if
+                          statuses[path] != BatchWriter.UNCHANGED],
+                         args.output_format)
+            if args.git_commit:
+                print("\nDon't forget to copy the icon to the recipe's "
+                      "directory!\n")
+            else:
+                print("\nDon't forget to copy the icon to the recipe's "
+                      "directory, and commit your changes to git!\n")
+
+    interrupted = False
+    try:
+        for parent, task in prefetch(prepare, parents,
+                                     background=args.prefetch):
+            print(parent)
+            # Each recipe stands alone; a problem with one should not
+            # cost us the rest of the run.
+            try:
+                queued_recipe = create_recipe_file(
+                    parent, task, j, args, env, recipe_index, manifest,
+                    writer)
+                if queued_recipe:
+                    queued.append((parent,) + queued_recipe)
+            except Exception as error:  # pylint: disable=broad-except
+                print("\nFailed to create a recipe from %s: %s" %
+                      (parent, error))
+                manifest.add_skipped(parent, error)
+                failures.append(parent)
+            if len(queued) >= args.batch_size:
+                flush()
+        flush()
+    except KeyboardInterrupt:
+        print("\nInterrupted. Run again with --resume to pick up where "
+              "this run left off.")
+        interrupted = True
+    finally:
+        journal.close()
+        if answer_store is not None and not args.dry_run:
+            try:
+                answer_store.write_plist()
+            except Error as error:
+                print("\nCould not save learned answers: %s" % error)
+
+    if args.dry_run:
+        args.provision = args.manifest = args.git_commit = None
+    if args.git_commit and not interrupted and written:
+        paths = [path for path, _, _ in written]
+        for path, _, results in written:
+            icon = os.path.join(os.path.dirname(path),
+                                results.get("SELF_SERVICE_ICON") or "")
+            if os.path.isfile(icon) and icon not in paths:
+                paths.append(icon)
+        try:
+            print("\nCommitted %s" % git_commit(paths, commit_message(
+                [(path, status, results["Identifier"]) for
+                 path, status, results in written])))
+        except GitError as error:
+            print("\nCould not commit to git: %s" % error)
+            failures.append("git commit")
+    if args.provision and not interrupted and manifest["Recipes"]:
+        try:
+            if provision(j, [os.path.join(args.dest, entry["Filename"]) for
+                             entry in manifest["Recipes"]],
+                         [os.curdir, os.path.dirname(
+                             env.get("Default_Group_Template", ""))]):
+                failures.append("Provisioning")
+        except (Error, jss.exceptions.JSSError) as error:
+            print("\nProvisioning failed: %s" % error)
+            failures.append("Provisioning")
+
+    if args.manifest:
+        manifest.write_plist(args.manifest)
+        print("Wrote manifest to %s" % args.manifest)
+    if failures:
+        print_heading("Failures")
+        print("\n".join(failures))
+    if failures or interrupted:
+        sys.exit(1)
+
+
+def create_recipe_file(parent, task, j, args, env, recipe_index, manifest,
+                       writer):
+    """Ask the questions for one parent recipe and queue its recipe.
+
+    Args:
+        parent: String path to the parent recipe.
+        task: BackgroundTask preparing (JSSRecipe, parent Recipe, Menu)
+            for parent. Menu is None with --auto.
+        j: A python-jss JSS object.
+        args: Arguments returned from argparser.
+        env: JSSRecipeCreator preferences dict.
+        recipe_index: RecipeIndex of existing recipes.
+        manifest: Manifest to record skipped recipes in.
+        writer: BatchWriter to queue the recipe with.
+
+    Returns:
+        Tuple of (string path the recipe will be written to, results
+        dict), or None if it was skipped because of a collision.
+    """
+    # Build our interactive menu
+    recipe, parent_recipe, menu = task.result()
+
+    if menu is None:
+        # --auto: only ask what has no default.
+        results = resolve_answers(j, parent_recipe, recipe, parent, env,
+                                  args.package_only, args.output_format)
+    else:
+        # Run the questions past the user.
+        menu.run(auto=args.auto, package_only=args.package_only)
+        results = menu.results
+
+    print_heading("Results")
+    pprint(results)
+
+    # Make sure nothing else already uses this recipe's identifier
+    # or filename.
+    try:
+        results["Identifier"], dest_path = recipe_index.claim(
+            results["Identifier"],
+            os.path.join(args.dest, results["Recipe Filename"]),
+            suffix=args.on_collision == "suffix")
+    except CollisionError as error:
+        print("\nSkipping %s: %s" % (parent, error))
+        manifest.add_skipped(parent, error)
+        return None
+    # The filename may have been suffixed.
+    results["Recipe Filename"] = os.path.relpath(dest_path, args.dest)
+
+    # Merge the answers with the JSSRecipe.
+    recipe.update_recipe(results, args.package_only, env.get("Recipe_Comment", ""))
+    writer.add(dest_path, recipe.serialize(args.output_format))
+    return dest_path, results
 
 
 if __name__ == "__main__":
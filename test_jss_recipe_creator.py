@@ -0,0 +1,246 @@
+#!/usr/local/autopkg/python
+# Copyright (C) 2014 Shea G Craig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""test_jss_recipe_creator.py
+
+Tests for jss_recipe_creator.py. Run them with pytest from the
+repository root:
+
+    python -m pytest test_jss_recipe_creator.py
+
+The creator needs PyObjC's Foundation and python-jss, so the tests are
+skipped without them. Anything which talks to a JSS talks to a
+fake_jss_server.FakeJSSServer on localhost.
+"""
+
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip("Foundation")
+jss = pytest.importorskip("jss")
+
+# pylint: disable=wrong-import-position
+import fake_jss_server
+import jss_recipe_creator as creator
+# pylint: enable=wrong-import-position
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "Templates", "RecipeTemplate.plist")
+
+# Configurations in which the answer resolver must match the --auto
+# menus: (description, template Input overrides, preferences,
+# package_only, scripted replies to any prompts).
+ANSWER_CASES = (
+    ("pre-filled template", {}, {}, False, []),
+    ("blank categories, prompted",
+     {"CATEGORY": "", "POLICY_CATEGORY": ""}, {}, False,
+     ["1", "New Category"]),
+    ("blank description, prompted", {"SELF_SERVICE_DESCRIPTION": ""}, {},
+     False, ["A description."]),
+    ("policy template from preferences", {"POLICY_TEMPLATE": ""},
+     {"Default_Policy_Template": "PolicyTemplate.xml"}, False, []),
+    ("missing preferred policy template, prompted", {"POLICY_TEMPLATE": ""},
+     {"Default_Policy_Template": "Missing.xml"}, False, ["1"]),
+    ("package only", {}, {}, True, []),
+    ("package only, blank category, prompted", {"CATEGORY": ""}, {}, True,
+     ["2"]),
+)
+
+
+@pytest.fixture
+def serve():
+    """Return a function which serves a FakeJSS and returns a scheduler.
+
+    The scheduler isn't rate limited; every server is shut down when
+    the test finishes.
+    """
+    servers = []
+
+    def start(fake=None):
+        """Serve fake (or a default FakeJSS) and return a scheduler."""
+        server = fake_jss_server.FakeJSSServer(
+            fake or fake_jss_server.FakeJSS())
+        server.start()
+        servers.append(server)
+        return creator.JSSRequestScheduler(
+            jss.JSS(url=server.url, user="user", password="password",
+                    ssl_verify=False, suppress_warnings=True),
+            requests_per_second=0)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def new_recipe(inputs=None):
+    """Return a fresh template JSSRecipe, with Input overrides."""
+    recipe = creator.JSSRecipe(TEMPLATE)
+    recipe["Input"]["CATEGORY"] = "Category 1"
+    recipe["Input"]["SELF_SERVICE_DESCRIPTION"] = "Test."
+    recipe["Input"].update(inputs or {})
+    return recipe
+
+
+def new_parent(name):
+    """Return a minimal parent recipe dict for a product."""
+    return {"Identifier": "com.example.pkg.%s" % name,
+            "Input": {"NAME": name}, "Process": []}
+
+
+@pytest.mark.parametrize("inputs, env, package_only, script",
+                         [case[1:] for case in ANSWER_CASES],
+                         ids=[case[0] for case in ANSWER_CASES])
+# pylint: disable=redefined-outer-name, too-many-arguments
+def test_resolver_matches_menus(serve, tmpdir, monkeypatch, inputs, env,
+                                package_only, script):
+    """The answer resolver gives the same answers as the --auto menus,
+    asking the same questions along the way."""
+    j = serve()
+    monkeypatch.chdir(tmpdir)
+    for name in ("PolicyTemplate.xml", "SmartGroupTemplate.xml"):
+        tmpdir.join(name).write("")
+    parent = new_parent("Compared")
+    filename = "Compared.pkg.recipe"
+
+    answers = []
+    for resolve in (False, True):
+        prompts = []
+        replies = iter(script)
+
+        def scripted(prompt, prompts=prompts, replies=replies):
+            """Answer a prompt from the script."""
+            prompts.append(prompt)
+            return next(replies, "")
+
+        monkeypatch.setattr(creator, "input", scripted)
+        recipe = new_recipe(inputs)
+        if resolve:
+            results = creator.resolve_answers(j, parent, recipe, filename,
+                                              env, package_only)
+        else:
+            menu = creator.build_menu(j, parent, recipe, filename, env,
+                                      package_only)
+            menu.run(auto=True, package_only=package_only)
+            results = menu.results
+        answers.append((results, prompts))
+
+    assert answers[0] == answers[1]
+    assert len(answers[0][1]) >= len(script)
+# pylint: enable=redefined-outer-name, too-many-arguments
+
+
+@pytest.mark.parametrize("misbehavior",
+                         [{}, {"error_rate": 0.1, "throttle_rate": 0.1}],
+                         ids=["clean", "errors and throttling"])
+# pylint: disable=redefined-outer-name
+def test_provision_creates_objects_once(serve, tmpdir, misbehavior):
+    """Provisioning creates every missing category and smart group the
+    first time, and nothing the second, retrying through failed and
+    throttled requests."""
+    fake = fake_jss_server.FakeJSS(**misbehavior)
+    j = serve(fake)
+    paths = []
+    for index in range(10):
+        recipe = new_recipe(
+            {"CATEGORY": "New Category %d" % (index % 5)})
+        results = creator.resolve_answers(
+            j, new_parent("Product%d" % index), recipe,
+            "Product%d.pkg.recipe" % index, {}, False)
+        recipe.update_recipe(results, False)
+        paths.append(str(tmpdir.join(results["Recipe Filename"])))
+        recipe.write_plist(paths[-1])
+    template_folders = [os.path.dirname(TEMPLATE)]
+
+    assert creator.provision(j, paths, template_folders) == []
+    categories, groups = creator.collect_jss_objects(paths,
+                                                     template_folders)
+    assert categories and groups
+    missing = [name for name in categories if not
+               fake.find("categories", "name", name)]
+    for name in groups:
+        group = fake.find("computergroups", "name", name)
+        if group is None or not group["is_smart"]:
+            missing.append(name)
+    assert missing == []
+
+    posts = fake.requests.get(("POST", "computergroups"), 0)
+    assert creator.provision(j, paths, template_folders) == []
+    assert fake.requests.get(("POST", "computergroups"), 0) == posts
+# pylint: enable=redefined-outer-name
+
+
+@pytest.mark.parametrize("fast_import_threshold", [100, 0],
+                         ids=["index", "fast-import"])
+@pytest.mark.parametrize("from_file", [True, False],
+                         ids=["pathspecs on stdin", "git before 2.25"])
+def test_git_commit(tmpdir, monkeypatch, fast_import_threshold, from_file):
+    """Each batch of recipes becomes a single commit, leaving a clean
+    working tree."""
+    if not from_file:
+        monkeypatch.setattr(creator, "git_version", lambda folder: (2, 24))
+        monkeypatch.setattr(creator, "GIT_PATHSPEC_CHUNK", 3)
+    folder = str(tmpdir)
+    subprocess.check_call(["git", "init", "-q", folder])
+    for option in ("user.name", "user.email"):
+        subprocess.check_call(["git", "-C", folder, "config", option,
+                               "test@example.com"])
+
+    # Add every recipe, then rewrite them all.
+    for attempt, status in enumerate((creator.BatchWriter.NEW,
+                                      creator.BatchWriter.CHANGED)):
+        written = []
+        for index in range(20):
+            recipe = creator.JSSRecipe(TEMPLATE)
+            recipe["Identifier"] = "com.example.jss.Product%d" % index
+            recipe["Comment"] = "Attempt %d" % attempt
+            path = os.path.join(folder, "Product %d.jss.recipe" % index)
+            recipe.write_plist(path)
+            written.append((path, status, recipe["Identifier"]))
+        creator.git_commit([path for path, _, _ in written],
+                           creator.commit_message(written),
+                           fast_import_threshold)
+
+        assert not subprocess.check_output(
+            ["git", "-C", folder, "status", "--porcelain"])
+        assert int(subprocess.check_output(
+            ["git", "-C", folder, "rev-list", "--count", "HEAD"])) == (
+                attempt + 1)
+
+
+def test_learned_answers_by_prefix(tmpdir):
+    """Products sharing an identifier prefix share categories, but not
+    descriptions, policy templates or groups."""
+    store = creator.AnswerStore(str(tmpdir.join("answers.plist")))
+    store.record({"ParentRecipe": "com.github.foo.pkg.First",
+                  "NAME": "First", "CATEGORY": "Utilities",
+                  "POLICY_CATEGORY": "Testing",
+                  "POLICY_TEMPLATE": "PolicyTemplate.xml",
+                  "SELF_SERVICE_DESCRIPTION": "The first product.",
+                  "groups": [{"name": "First-Testing", "smart": True}]})
+    store.write_plist()
+    store = creator.AnswerStore(store.path)
+
+    assert store.defaults("com.github.foo.pkg.Second", "Second") == {
+        "CATEGORY": "Utilities", "POLICY_CATEGORY": "Testing"}
+    assert store.defaults("com.github.foo.pkg.First", "First")[
+        "SELF_SERVICE_DESCRIPTION"] == "The first product."